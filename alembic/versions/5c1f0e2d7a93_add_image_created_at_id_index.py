@@ -0,0 +1,30 @@
+"""add image created_at id index
+
+Revision ID: 5c1f0e2d7a93
+Revises: 34aa2cc482b1
+Create Date: 2026-10-18 10:12:41.218734
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "5c1f0e2d7a93"
+down_revision: Union[str, None] = "34aa2cc482b1"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Matches the (created_at, id) sort key used for gallery pagination
+    op.create_index(
+        "ix_image_created_at_id", "image", ["created_at", "id"], unique=False
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_image_created_at_id", table_name="image")
@@ -0,0 +1,35 @@
+"""add image processing
+
+Revision ID: 8e4b6f1c2d05
+Revises: 5c1f0e2d7a93
+Create Date: 2026-10-18 11:03:27.514219
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "8e4b6f1c2d05"
+down_revision: Union[str, None] = "5c1f0e2d7a93"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column(
+        "image",
+        sa.Column(
+            "processing", sa.Boolean(), nullable=False, server_default=sa.false()
+        ),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table("image") as batch_op:
+        batch_op.drop_column("processing")
@@ -0,0 +1,47 @@
+"""create category count table
+
+Revision ID: a7c3e19d5b42
+Revises: f4a2c6e8b913
+Create Date: 2026-10-18 18:41:07.523916
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "a7c3e19d5b42"
+down_revision: Union[str, None] = "f4a2c6e8b913"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+image = sa.table(
+    "image", sa.column("category", sa.String), sa.column("processing", sa.Boolean)
+)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    category_count = op.create_table(
+        "category_count",
+        sa.Column("category", sa.String(), primary_key=True),
+        sa.Column("count", sa.Integer(), nullable=False),
+    )
+
+    op.execute(
+        category_count.insert().from_select(
+            ["category", "count"],
+            # Like ImageService, only images done processing are counted
+            sa.select(image.c.category, sa.func.count())
+            .where(~image.c.processing)
+            .group_by(image.c.category),
+        )
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table("category_count")
@@ -0,0 +1,30 @@
+"""add image renditions
+
+Revision ID: b71d3a9e4c28
+Revises: 8e4b6f1c2d05
+Create Date: 2026-10-18 12:41:09.377105
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "b71d3a9e4c28"
+down_revision: Union[str, None] = "8e4b6f1c2d05"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column("image", sa.Column("renditions", sa.JSON(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table("image") as batch_op:
+        batch_op.drop_column("renditions")
@@ -0,0 +1,33 @@
+"""create imported file table
+
+Revision ID: c5e8a2f47d19
+Revises: a7c3e19d5b42
+Create Date: 2026-10-18 21:12:44.381502
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "c5e8a2f47d19"
+down_revision: Union[str, None] = "a7c3e19d5b42"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "imported_file",
+        sa.Column("path", sa.String(), primary_key=True),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table("imported_file")
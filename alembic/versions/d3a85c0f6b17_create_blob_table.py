@@ -0,0 +1,41 @@
+"""create blob table
+
+Revision ID: d3a85c0f6b17
+Revises: b71d3a9e4c28
+Create Date: 2026-10-18 14:20:53.664082
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "d3a85c0f6b17"
+down_revision: Union[str, None] = "b71d3a9e4c28"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "blob",
+        sa.Column("content_hash", sa.String(length=64), primary_key=True),
+        sa.Column("ref_count", sa.Integer(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+    )
+    op.add_column(
+        "image", sa.Column("content_hash", sa.String(length=64), nullable=True)
+    )
+    op.create_index("ix_image_content_hash", "image", ["content_hash"], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_image_content_hash", table_name="image")
+    with op.batch_alter_table("image") as batch_op:
+        batch_op.drop_column("content_hash")
+    op.drop_table("blob")
@@ -0,0 +1,101 @@
+"""use image storage keys
+
+Revision ID: f4a2c6e8b913
+Revises: d3a85c0f6b17
+Create Date: 2026-10-18 16:02:31.118305
+
+Image paths are stored relative to IMAGE_DIRECTORY from now on, which has
+to be set to the directory the existing paths point into.
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+from gallery.config import get_config
+
+# revision identifiers, used by Alembic.
+revision: str = "f4a2c6e8b913"
+down_revision: Union[str, None] = "d3a85c0f6b17"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BATCH_SIZE = 1000
+
+image = sa.table(
+    "image",
+    sa.column("id", sa.Integer),
+    sa.column("storage_key", sa.String),
+    sa.column("thumbnail_key", sa.String),
+    sa.column("renditions", sa.JSON),
+)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.batch_alter_table("image") as batch_op:
+        batch_op.alter_column("url", new_column_name="storage_key")
+        batch_op.alter_column("thumbnail_url", new_column_name="thumbnail_key")
+
+    prefix = get_config().image_directory.rstrip("/") + "/"
+
+    for column in (image.c.storage_key, image.c.thumbnail_key):
+        op.execute(
+            image.update()
+            .where(column.startswith(prefix, autoescape=True))
+            .values({column.name: sa.func.substr(column, len(prefix) + 1)})
+        )
+
+    _rewrite_renditions("url", "key", lambda url: url.removeprefix(prefix))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    prefix = get_config().image_directory.rstrip("/") + "/"
+
+    for column in (image.c.storage_key, image.c.thumbnail_key):
+        op.execute(
+            image.update()
+            .where(column != "")
+            .values({column.name: sa.literal(prefix) + column})
+        )
+
+    _rewrite_renditions("key", "url", lambda key: prefix + key)
+
+    with op.batch_alter_table("image") as batch_op:
+        batch_op.alter_column("storage_key", new_column_name="url")
+        batch_op.alter_column("thumbnail_key", new_column_name="thumbnail_url")
+
+
+def _rewrite_renditions(old_field: str, new_field: str, rewrite) -> None:
+    connection = op.get_bind()
+    statement = (
+        image.update()
+        .where(image.c.id == sa.bindparam("b_id"))
+        .values(renditions=sa.bindparam("b_renditions"))
+    )
+    after = 0
+
+    while rows := connection.execute(
+        sa.select(image.c.id, image.c.renditions)
+        .where(image.c.id > after, image.c.renditions.isnot(None))
+        .order_by(image.c.id)
+        .limit(BATCH_SIZE)
+    ).all():
+        params = [
+            {
+                "b_id": image_id,
+                "b_renditions": [
+                    {"width": r["width"], new_field: rewrite(r[old_field])}
+                    for r in renditions
+                ],
+            }
+            for image_id, renditions in rows
+            if renditions
+        ]
+
+        if params:
+            connection.execute(statement, params)
+
+        after = rows[-1][0]
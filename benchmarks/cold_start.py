@@ -0,0 +1,56 @@
+"""Time spent on templates by the first requests of a freshly started worker.
+
+Compares compiling every template from source, as each new worker did
+before, with loading them from a populated bytecode cache. Every run
+happens in a fresh process, like a worker after a restart. With the
+warm-up enabled this time is spent at startup instead.
+
+    PYTHONPATH=. python benchmarks/cold_start.py
+"""
+
+import multiprocessing
+import tempfile
+import time
+
+from jinja2 import FileSystemBytecodeCache
+
+
+def load_templates(cache_directory, queue):
+    from gallery.templates import templates
+
+    if cache_directory:
+        templates.env.bytecode_cache = FileSystemBytecodeCache(cache_directory)
+
+    names = templates.env.list_templates(extensions=["jinja"])
+    start = time.perf_counter()
+
+    for name in names:
+        templates.env.get_template(name)
+
+    queue.put((len(names), time.perf_counter() - start))
+
+
+def measure(cache_directory):
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=load_templates, args=(cache_directory, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    with tempfile.TemporaryDirectory() as cache_directory:
+        # The first worker after a deploy fills the cache
+        measure(cache_directory)
+
+        print(f"{'templates':<10} {'source':<10} {'first load [ms]':>16}")
+
+        for label, directory in (("compiled", None), ("bytecode", cache_directory)):
+            count, elapsed = measure(directory)
+            print(f"{count:<10} {label:<10} {elapsed * 1000:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
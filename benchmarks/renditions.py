@@ -0,0 +1,103 @@
+"""Peak memory and wall time of generating renditions for large uploads.
+
+Compares the current worker pipeline with the previous one, which fully
+decoded and copied the original before resizing. Every run happens in a
+fresh process so that ru_maxrss only reflects that run.
+
+    PYTHONPATH=. python benchmarks/renditions.py
+"""
+
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from os import path
+
+from PIL import Image
+
+from gallery import worker
+from gallery.storage import LocalStorage
+
+WIDTHS = [320, 640, 1280, 2048]
+INPUTS = {
+    "jpeg 48MP": ("JPEG", (8000, 6000)),
+    "png 24MP": ("PNG", (6000, 4000)),
+}
+
+
+def legacy_renditions(img_path, widths):
+    rendition_dir = path.join(path.dirname(img_path), "renditions")
+    os.makedirs(rendition_dir, exist_ok=True)
+
+    with Image.open(img_path) as img:
+        original_width, original_height = img.size
+        rendition = img.convert("RGB")
+
+        for width in sorted(widths, reverse=True):
+            height = round(original_height * width / original_width)
+            rendition = rendition.resize((width, height), Image.Resampling.LANCZOS)
+            rendition.save(path.join(rendition_dir, f"{width}.jpg"), quality=85)
+
+
+def current_renditions(img_path, widths):
+    storage = LocalStorage(path.dirname(img_path))
+    worker.create_renditions(storage, path.basename(img_path), widths)
+
+
+def peak_rss_mb():
+    # ru_maxrss survives exec, so a spawned child would report the peak of
+    # the parent that created the inputs. VmHWM is reset for a new process.
+    if path.exists("/proc/self/status"):
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    return max_rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run(fn, img_path, queue):
+    start = time.perf_counter()
+    fn(img_path, WIDTHS)
+    elapsed = time.perf_counter() - start
+    queue.put((elapsed, peak_rss_mb()))
+
+
+def measure(fn, img_path):
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=run, args=(fn, img_path, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def create_input(directory, name, format, size):
+    img_path = path.join(directory, name.replace(" ", "_") + "." + format.lower())
+    # Noise instead of a flat color, so encoders and decoders do real work
+    Image.effect_noise(size, 64).convert("RGB").save(img_path, format=format)
+    return img_path
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'input':<12} {'pipeline':<8} {'wall [s]':>9} {'peak RSS [MB]':>14}")
+
+        for name, (format, size) in INPUTS.items():
+            img_path = create_input(directory, name, format, size)
+
+            for label, fn in (
+                ("before", legacy_renditions),
+                ("after", current_renditions),
+            ):
+                elapsed, peak_rss = measure(fn, img_path)
+                print(f"{name:<12} {label:<8} {elapsed:>9.2f} {peak_rss:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
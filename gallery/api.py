@@ -1,29 +1,120 @@
+import hashlib
 import logging
-from typing import Annotated
-
-from fastapi import Depends, FastAPI, File, Form, Request, UploadFile, responses, status
+from typing import Annotated, Optional
+
+from fastapi import (
+    Depends,
+    FastAPI,
+    File,
+    Form,
+    Path,
+    Request,
+    UploadFile,
+    responses,
+    status,
+)
 from fastapi.responses import HTMLResponse
+from pydantic import TypeAdapter
 from slowapi import Limiter
 
 import gallery.db as db
+import gallery.response_cache as response_cache
+import gallery.worker as worker
 from gallery import dto
 from gallery.config import Config
+from gallery.rendition_cache import RenditionCache
 from gallery.service import AuthService as Auth
-from gallery.service import ImageService
+from gallery.service import (
+    AsyncImageService,
+    ImageService,
+    InvalidCursorError,
+    InvalidImageError,
+    is_authenticated,
+)
+from gallery.static import is_rendition
+from gallery.storage import get_storage
 from gallery.templates import TemplateRenderer
 
 PAGE_SIZE = 10
 
+# Room for the other form fields and the multipart framing of an upload
+FORM_OVERHEAD = 64 * 1024
+
+CATEGORIES = TypeAdapter(list[dto.CategoryDTO])
+
+
+def rendition_key(
+    image: db.Image, width: int, rendition_format: worker.RenditionFormat
+) -> str:
+    """Cache key of a resized image, changing whenever its content does."""
+    extension = rendition_format.extension
+
+    if image.content_hash:
+        return f"{image.content_hash}-{width}{extension}"
 
-def is_authenticated(request: Request, auth: Annotated[Auth, Depends()]):
-    token = request.cookies.get("gallery")
+    # Legacy images are stored under a new storage key on each upload
+    key_hash = hashlib.sha256(image.storage_key.encode()).hexdigest()[:16]
+    return f"{image.id}-{key_hash}-{width}{extension}"
 
-    if token:
-        return auth.verify_token(token)
-    return False
+
+def cached_json(
+    request: Request,
+    cached: response_cache.CachedResponse,
+    vary: Optional[str] = None,
+) -> responses.Response:
+    """Responds with a cached body, or 304 if the client has it already."""
+    # Clients revalidate every time, which is cheap with the cache
+    headers = {"etag": cached.etag, "cache-control": "no-cache"}
+
+    if vary:
+        headers["vary"] = vary
+
+    if cached.etag in request.headers.get("if-none-match", ""):
+        return responses.Response(
+            status_code=status.HTTP_304_NOT_MODIFIED, headers=headers
+        )
+
+    return responses.Response(
+        cached.body, media_type="application/json", headers=headers
+    )
 
 
 def configure(app: FastAPI, limiter: Limiter, config: Config):
+    rendition_cache = RenditionCache(
+        config.rendition_cache_directory, config.rendition_cache_size
+    )
+    response_cache.init(config)
+
+    @app.exception_handler(worker.Saturated)
+    def worker_saturated(request: Request, exc: worker.Saturated):
+        logging.warning(f"Image processing is saturated, rejecting {request.url}")
+
+        return responses.PlainTextResponse(
+            "Too many images are being processed, please try again shortly.",
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            headers={"retry-after": "10"},
+        )
+
+    @app.middleware("http")
+    async def limit_request_size(request: Request, call_next):
+        """Rejects oversized uploads before their body is received.
+
+        Starlette spools the whole form to disk before the endpoint runs,
+        so the size check while storing the upload would come too late.
+        """
+        content_length = request.headers.get("content-length", "")
+
+        if (
+            content_length.isdigit()
+            and int(content_length) > config.max_upload_size + FORM_OVERHEAD
+        ):
+            return responses.PlainTextResponse(
+                "The image is too large",
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            )
+
+        return await call_next(request)
+
     @app.get("/", response_class=HTMLResponse)
     def root():
         return responses.RedirectResponse(
@@ -31,25 +122,50 @@ def configure(app: FastAPI, limiter: Limiter, config: Config):
         )
     
     @app.get("/b/", response_class=HTMLResponse)
-    def home(
-        service: Annotated[ImageService, Depends()],
+    async def home(
+        service: Annotated[AsyncImageService, Depends()],
         renderer: Annotated[TemplateRenderer, Depends()],
         is_authenticated: Annotated[bool, Depends(is_authenticated)],
     ):
         images = []
+        next_cursor = None
 
         if is_authenticated:
-            images = service.get_images()
+            page = await service.get_image_page_after(
+                "", PAGE_SIZE, "", include_processing=True
+            )
+            images = page["content"]
+            next_cursor = page["next_cursor"]
 
-        for image in images:
-            image.url = image.url.replace(
-                config.image_directory, config.gallery_endpoint
+        return renderer.render(
+            name="home.html.jinja",
+            context={"images": images, "next_cursor": next_cursor},
+        )
+
+    @app.get("/b/images/cards", response_class=HTMLResponse)
+    async def get_image_cards(
+        service: Annotated[AsyncImageService, Depends()],
+        renderer: Annotated[TemplateRenderer, Depends()],
+        is_authenticated: Annotated[bool, Depends(is_authenticated)],
+        cursor: str = "",
+    ):
+        """Renders the next page of home cards, fetched while scrolling."""
+        if not is_authenticated:
+            return responses.Response(status_code=status.HTTP_401_UNAUTHORIZED)
+
+        try:
+            page = await service.get_image_page_after(
+                cursor, PAGE_SIZE, "", include_processing=True
             )
-            image.thumbnail_url = image.thumbnail_url.replace(
-                config.image_directory, config.gallery_endpoint
+        except InvalidCursorError:
+            return responses.PlainTextResponse(
+                "Invalid cursor", status_code=status.HTTP_400_BAD_REQUEST
             )
 
-        return renderer.render(name="home.html.jinja", context={"images": images})
+        return renderer.render(
+            name="image_cards.html.jinja",
+            context={"images": page["content"], "next_cursor": page["next_cursor"]},
+        )
 
     @app.get("/b/login", response_class=HTMLResponse)
     def login_form(renderer: Annotated[TemplateRenderer, Depends()]):
@@ -118,6 +234,7 @@ def configure(app: FastAPI, limiter: Limiter, config: Config):
         description: Annotated[str, Form()],
         category: Annotated[str, Form()],
         service: Annotated[ImageService, Depends()],
+        renderer: Annotated[TemplateRenderer, Depends()],
         is_authenticated: Annotated[bool, Depends(is_authenticated)],
     ):
         if not is_authenticated:
@@ -131,7 +248,16 @@ def configure(app: FastAPI, limiter: Limiter, config: Config):
             category=category,
         )
 
-        service.save(imageData, image)
+        try:
+            service.save(imageData, image)
+        except InvalidImageError as e:
+            return renderer.render(
+                name="add_image.html.jinja",
+                context={
+                    "categories": db.Category,
+                    "errors": [renderer.translate(str(e))],
+                },
+            )
 
         return responses.RedirectResponse(url="/b/", status_code=status.HTTP_302_FOUND)
 
@@ -148,25 +274,27 @@ def configure(app: FastAPI, limiter: Limiter, config: Config):
             )
 
         image = service.get_image(image_id)
-        image.url = image.url.replace(config.image_directory, config.gallery_endpoint)
-        image.thumbnail_url = image.thumbnail_url.replace(
-            config.image_directory, config.gallery_endpoint
-        )
 
         return renderer.render(
             name="edit_image.html.jinja",
-            context={"image": image, "categories": db.Category},
+            context={
+                "image": image,
+                "image_url": service.urls.url(image.storage_key),
+                "srcset": service.urls.srcset(image.renditions),
+                "categories": db.Category,
+            },
         )
 
     @app.post("/b/images/{image_id}/edit", response_class=HTMLResponse)
     def update_image(
         image_id: int,
-        image: Annotated[UploadFile, File()],
         title: Annotated[str, Form()],
         description: Annotated[str, Form()],
         category: Annotated[str, Form()],
         service: Annotated[ImageService, Depends()],
+        renderer: Annotated[TemplateRenderer, Depends()],
         is_authenticated: Annotated[bool, Depends(is_authenticated)],
+        image: Annotated[Optional[UploadFile], File()] = None,
     ):
         if not is_authenticated:
             return responses.RedirectResponse(
@@ -175,11 +303,19 @@ def configure(app: FastAPI, limiter: Limiter, config: Config):
 
         imageData = service.get_image(image_id)
 
-        imageData.title = title
-        imageData.description = description
-        imageData.category = category
-
-        service.save(imageData, image)
+        try:
+            service.update(imageData, title, description, category, image)
+        except InvalidImageError as e:
+            return renderer.render(
+                name="edit_image.html.jinja",
+                context={
+                    "image": imageData,
+                    "image_url": service.urls.url(imageData.storage_key),
+                    "srcset": service.urls.srcset(imageData.renditions),
+                    "categories": db.Category,
+                    "errors": [renderer.translate(str(e))],
+                },
+            )
 
         return responses.RedirectResponse(url="/b/", status_code=status.HTTP_302_FOUND)
 
@@ -199,42 +335,148 @@ def configure(app: FastAPI, limiter: Limiter, config: Config):
 
     @app.get("/b/images/gallery")
     @limiter.limit("30/minute")
-    def get_gallery(
+    async def get_gallery(
         request: Request,
-        service: Annotated[ImageService, Depends()],
+        service: Annotated[AsyncImageService, Depends()],
         page: int = 1,
         category: str = "",
+        cursor: str = "",
     ) -> dto.Page:
-        try:
-            return service.get_image_page(page, PAGE_SIZE, category)
-        except Exception as e:
-            logging.error(f"Error fetching images: {e}")
-
-            return dto.Page(
-                page_no=1,
-                page_size=0,
-                total=0,
-                total_pages=0,
-                has_next=False,
-                has_previous=False,
-                content=[],
-            )
+        key = ("gallery", page, category, cursor)
+        cached = response_cache.get(key)
+
+        if cached is None:
+            version = response_cache.version()
+
+            try:
+                if cursor:
+                    result = await service.get_image_page_after(
+                        cursor, PAGE_SIZE, category
+                    )
+                else:
+                    result = await service.get_image_page(page, PAGE_SIZE, category)
+            except InvalidCursorError:
+                return responses.PlainTextResponse(
+                    "Invalid cursor", status_code=status.HTTP_400_BAD_REQUEST
+                )
+            except Exception as e:
+                logging.error(f"Error fetching images: {e}")
+
+                return dto.Page(
+                    page_no=1,
+                    page_size=0,
+                    total=0,
+                    total_pages=0,
+                    has_next=False,
+                    has_previous=False,
+                    content=[],
+                )
+
+            body = dto.Page.model_validate(result).model_dump_json().encode()
+            cached = response_cache.put(key, version, body)
+
+        return cached_json(request, cached)
 
     @app.get("/b/images/categories")
     @limiter.limit("30/minute")
-    def get_categories(
+    async def get_categories(
         request: Request,
-        service: Annotated[ImageService, Depends()],
+        service: Annotated[AsyncImageService, Depends()],
         renderer: Annotated[TemplateRenderer, Depends()],
     ) -> list[dto.CategoryDTO]:
-        try:
-            return [
-                dto.CategoryDTO(
-                    key=category,
-                    name=renderer.translate(category),
+        # Category names are translated
+        key = ("categories", renderer.language)
+        cached = response_cache.get(key)
+
+        if cached is None:
+            version = response_cache.version()
+
+            try:
+                categories = [
+                    dto.CategoryDTO(
+                        key=category,
+                        name=renderer.translate(category),
+                        count=count,
+                    )
+                    for category, count in await service.get_categories()
+                ]
+            except Exception as e:
+                logging.error(f"Error fetching categories: {e}")
+                return []
+
+            cached = response_cache.put(key, version, CATEGORIES.dump_json(categories))
+
+        return cached_json(request, cached, vary="Accept-Language")
+
+    # Registered before the image mount at the same prefix, which would
+    # otherwise take precedence
+    @app.get(config.gallery_endpoint + "/{image_id}/w/{width}")
+    @limiter.limit("60/minute")
+    def get_resized_image(
+        request: Request,
+        image_id: int,
+        width: Annotated[int, Path(ge=16, le=4096)],
+        service: Annotated[ImageService, Depends()],
+    ):
+        image = service.get_image(image_id)
+
+        if image is None:
+            return responses.Response(status_code=status.HTTP_404_NOT_FOUND)
+
+        rendition_format = worker.negotiate_format(request.headers.get("accept", ""))
+        key = rendition_key(image, width, rendition_format)
+        # The URL points to the current content of an image, which can change
+        headers = {
+            "etag": f'"{key}"',
+            "cache-control": "public, max-age=86400",
+            "vary": "Accept",
+        }
+
+        if headers["etag"] in request.headers.get("if-none-match", ""):
+            return responses.Response(
+                status_code=status.HTTP_304_NOT_MODIFIED, headers=headers
+            )
+
+        resized_path = rendition_cache.get(
+            key,
+            lambda resized_path: worker.run(
+                worker.create_resized,
+                service.storage,
+                image.storage_key,
+                width,
+                resized_path,
+                rendition_format,
+            ),
+        )
+
+        return responses.FileResponse(
+            resized_path, media_type=rendition_format.media_type, headers=headers
+        )
+
+    if config.storage_backend != "local":
+        storage = get_storage(config)
+
+        # Registered instead of the ImageFiles mount, clients fetch the files
+        # from the storage directly
+        @app.get(config.gallery_endpoint + "/{key:path}")
+        def get_stored_image(request: Request, key: str):
+            # Presigned URLs stay valid a while longer than they are cached
+            max_age = config.s3_url_expiry // 2
+            headers = {"cache-control": f"private, max-age={max_age}"}
+
+            if is_rendition(key):
+                rendition_format = worker.negotiate_format(
+                    request.headers.get("accept", "")
                 )
-                for category in service.get_categories()
-            ]
-        except Exception as e:
-            logging.error(f"Error fetching categories: {e}")
-            return []
+                # Every rendition is stored in all RENDITION_FORMATS
+                key = (
+                    key.removesuffix(worker.JPEG.extension)
+                    + rendition_format.extension
+                )
+                headers["vary"] = "Accept"
+
+            return responses.RedirectResponse(
+                url=storage.redirect_url(key),
+                status_code=status.HTTP_307_TEMPORARY_REDIRECT,
+                headers=headers,
+            )
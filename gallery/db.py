@@ -2,16 +2,48 @@ from datetime import datetime
 from enum import Enum
 from typing import Optional
 
+from sqlalchemy import JSON, Column, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
 from sqlmodel import Field, Session, SQLModel, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 import gallery.config as config
 
 engine = None
+async_engine = None
 
 
 def init(config: config.Config) -> None:
-    global engine
-    engine = create_engine(config.database_url, echo=True)
+    """Creates the engines, the async one is used by the read endpoints."""
+    global engine, async_engine
+
+    engine = create_engine(config.database_url, **_engine_options(config))
+
+    async_options = _engine_options(config)
+    if config.mode.is_test():
+        # Every TestClient request runs in a new event loop, which must not
+        # reuse connections created in another one
+        async_options = {"echo": async_options["echo"], "poolclass": NullPool}
+
+    async_engine = create_async_engine(config.async_database_url, **async_options)
+
+
+def _engine_options(config: config.Config) -> dict:
+    options = {
+        "echo": config.mode.is_dev(),
+        "pool_size": config.db_pool_size,
+        "max_overflow": config.db_max_overflow,
+        "pool_pre_ping": config.db_pool_pre_ping,
+    }
+
+    if config.database_url.startswith("postgresql"):
+        options["connect_args"] = {
+            "options": f"-c statement_timeout={config.db_statement_timeout}"
+        }
+
+    return options
 
 
 def session():
@@ -23,6 +55,11 @@ def session():
         s.close()
 
 
+async def async_session():
+    async with AsyncSession(async_engine) as s:
+        yield s
+
+
 class Category(str, Enum):
     GRIEF = "grief"
     LOVE = "love"
@@ -43,12 +80,70 @@ class Image(SQLModel, table=True):
     title: str
     description: Optional[str] = None
     category: str
-    url: str
-    thumbnail_url: Optional[str] = None
+    # Paths relative to the image directory, see gallery.storage
+    storage_key: str
+    # SHA-256 of the original, shared by images with identical content
+    content_hash: Optional[str] = Field(default=None, index=True)
+    thumbnail_key: Optional[str] = None
+    # Resized copies as [{"width": ..., "key": ...}], smallest first
+    renditions: Optional[list] = Field(
+        default=None, sa_column=Column(JSON(none_as_null=True))
+    )
+    # True while the worker is still generating the derivatives
+    processing: bool = False
     created_at: datetime
     updated_at: datetime
 
 
+class Blob(SQLModel, table=True):
+    """A stored original, referenced by all images with the same content."""
+
+    content_hash: str = Field(primary_key=True)
+    ref_count: int = 1
+    created_at: datetime
+
+
+class CategoryCount(SQLModel, table=True):
+    """Number of images in a category, see count_category()."""
+
+    __tablename__ = "category_count"
+
+    category: str = Field(primary_key=True)
+    count: int = 0
+
+
+class ImportedFile(SQLModel, table=True):
+    """A file taken in by import_images.py, which skips it when run again."""
+
+    __tablename__ = "imported_file"
+
+    path: str = Field(primary_key=True)
+    created_at: datetime
+
+
+def count_category(session: Session, category: str, delta: int) -> None:
+    """Adjusts the image count of a category in the current transaction.
+
+    Only images that are done processing are counted, as only those are
+    listed in the gallery.
+    """
+    statement = (
+        update(CategoryCount)
+        .where(CategoryCount.category == category)
+        .values(count=CategoryCount.count + delta)
+    )
+
+    if session.exec(statement).rowcount > 0:
+        return
+
+    try:
+        # The first image of a category may be saved concurrently
+        with session.begin_nested():
+            session.add(CategoryCount(category=category, count=delta))
+    except IntegrityError:
+        session.exec(statement)
+
+
 class User(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     username: str
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 
 from pydantic import BaseModel
 
@@ -9,19 +9,25 @@ class ImageDTO(BaseModel):
     description: str
     category: str
     image_url: str
-    thumbnail_url: str
+    thumbnail_url: Optional[str]
+    srcset: Optional[str]
+    processing: bool
 
 
 class Page(BaseModel):
-    page_no: int
+    # page_no, total and total_pages are not known when paging by cursor
+    page_no: Optional[int]
     page_size: int
-    total: int
-    total_pages: int
+    total: Optional[int]
+    total_pages: Optional[int]
     has_next: bool
     has_previous: bool
+    next_cursor: Optional[str] = None
     content: List[ImageDTO]
 
 
 class CategoryDTO(BaseModel):
     key: str
     name: str
+    # Images still being processed are not listed, nor counted
+    count: int
@@ -0,0 +1,112 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from os import path
+from typing import Callable
+from uuid import uuid4
+
+# Temporary files older than this were left behind by an interrupted creation
+STALE_TMP_AGE = 3600
+
+
+class RenditionCache:
+    """Size-bounded LRU cache of generated images on disk.
+
+    Entries are tracked in memory in least recently used order and the
+    oldest files are removed once the total size exceeds max_size. On
+    startup the existing files are adopted, oldest access first.
+
+    Every process sharing the directory keeps its own view of it, so
+    max_size applies per process and one process may evict files another
+    one still lists. Such files are simply created again.
+    """
+
+    def __init__(self, directory: str, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        self.size = 0
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._pending: dict[str, Future] = {}
+
+        os.makedirs(directory, exist_ok=True)
+
+        entries = [e for e in os.scandir(directory) if e.is_file()]
+        for entry in sorted(entries, key=lambda e: e.stat().st_atime):
+            if entry.name.startswith(".tmp-"):
+                # Younger ones may still be written by another process
+                if entry.stat().st_mtime < time.time() - STALE_TMP_AGE:
+                    os.remove(entry.path)
+                continue
+
+            self._entries[entry.name] = entry.stat().st_size
+            self.size += entry.stat().st_size
+
+        with self._lock:
+            self._evict()
+
+    def get(self, key: str, create: Callable[[str], None]) -> str:
+        """Returns the path of the cached file for key.
+
+        On a miss create is called with the path to write the file to.
+        Concurrent misses for the same key wait for a single creation
+        instead of doing the work again.
+        """
+        file_path = path.join(self.directory, key)
+
+        with self._lock:
+            if key in self._entries:
+                if path.exists(file_path):
+                    self._entries.move_to_end(key)
+                    return file_path
+
+                # Evicted by another process
+                self.size -= self._entries.pop(key)
+
+            future = self._pending.get(key)
+            is_owner = future is None
+
+            if is_owner:
+                future = self._pending[key] = Future()
+
+        if not is_owner:
+            return future.result()
+
+        try:
+            tmp_path = path.join(self.directory, f".tmp-{uuid4()}")
+
+            try:
+                create(tmp_path)
+                os.replace(tmp_path, file_path)
+            finally:
+                if path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+            with self._lock:
+                self._entries[key] = path.getsize(file_path)
+                self.size += self._entries[key]
+                self._evict()
+
+            future.set_result(file_path)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._pending[key]
+
+        return file_path
+
+    def _evict(self) -> None:
+        # The most recent entry is kept even if it alone exceeds the limit
+        while self.size > self.max_size and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self.size -= size
+
+            try:
+                os.remove(path.join(self.directory, key))
+            except OSError as e:
+                logging.warning(f"Could not evict {key} from rendition cache: {e}")
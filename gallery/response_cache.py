@@ -0,0 +1,104 @@
+"""Cache of the public JSON responses, e.g. gallery pages and categories.
+
+Entries are stored under the data version they were built from, which
+invalidate() bumps whenever images change; entries of older versions are
+never served again and age out of the LRU. With a version_file shared by
+all uvicorn workers, a change made in one of them, or by one of the
+command line tools, invalidates the caches of all of them.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Hashable, NamedTuple, Optional
+
+import gallery.config as config
+
+max_entries = 1000
+ttl = 60.0
+version_file: Optional[str] = None
+
+_lock = threading.Lock()
+_entries: OrderedDict[Hashable, "CachedResponse"] = OrderedDict()
+_version = 0
+
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    etag: str
+    expires: float
+
+
+def init(config: config.Config) -> None:
+    global max_entries, ttl, version_file
+
+    max_entries = config.response_cache_size
+    ttl = config.response_cache_ttl
+    version_file = config.response_cache_version_file
+
+    with _lock:
+        _entries.clear()
+
+
+def version() -> Hashable:
+    """The current data version, to be read before the data itself."""
+    if version_file is None:
+        return _version
+
+    try:
+        return _version, os.stat(version_file).st_mtime_ns
+    except FileNotFoundError:
+        return _version, None
+
+
+def invalidate() -> None:
+    """Makes all cached responses stale; call it after committing changes."""
+    global _version
+
+    with _lock:
+        _version += 1
+        _entries.clear()
+
+    if version_file is not None:
+        with open(version_file, "a"):
+            pass
+
+        os.utime(version_file)
+
+
+def get(key: Hashable) -> Optional[CachedResponse]:
+    entry_key = (key, version())
+
+    with _lock:
+        cached = _entries.get(entry_key)
+
+        if cached is None:
+            return None
+
+        if cached.expires < time.monotonic():
+            del _entries[entry_key]
+            return None
+
+        _entries.move_to_end(entry_key)
+        return cached
+
+
+def put(key: Hashable, data_version: Hashable, body: bytes) -> CachedResponse:
+    """Caches body as built from data_version, see version()."""
+    cached = CachedResponse(
+        body=body,
+        etag=f'"{hashlib.sha256(body).hexdigest()[:16]}"',
+        expires=time.monotonic() + ttl,
+    )
+
+    with _lock:
+        if max_entries > 0:
+            _entries[(key, data_version)] = cached
+            _entries.move_to_end((key, data_version))
+
+        while len(_entries) > max_entries:
+            _entries.popitem(last=False)
+
+    return cached
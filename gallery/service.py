@@ -1,149 +1,570 @@
+import base64
+import hashlib
+import json
 import logging
 import os
-import shutil
+import warnings
+from contextlib import nullcontext
 from datetime import datetime, timedelta
+from functools import lru_cache
 from os import path
 from typing import Annotated, List, Optional
-from uuid import uuid4
 
 from argon2 import PasswordHasher
-from fastapi import Depends, UploadFile
+from fastapi import Depends, Request, UploadFile
 from itsdangerous import URLSafeSerializer
 from PIL import Image
-from sqlmodel import Session, select
+from sqlalchemy import tuple_, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, func, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 import gallery.config as config
 import gallery.db as db
+import gallery.response_cache as response_cache
+import gallery.worker as worker
 from gallery import dto
+from gallery.storage import Storage, UrlBuilder, get_storage, storage_directory
 
 
-class ImageService:
-    def __init__(self, session: Annotated[Session, Depends(db.session)]):
+CHUNK_SIZE = 1024 * 1024
+
+IMAGE_SIGNATURES = {
+    b"\xff\xd8\xff": ".jpg",
+    b"\x89PNG\r\n\x1a\n": ".png",
+    b"GIF87a": ".gif",
+    b"GIF89a": ".gif",
+}
+
+
+# Stateless, so a single instance serves all requests
+password_hasher = PasswordHasher()
+
+
+class InvalidImageError(ValueError):
+    """Raised when an upload is rejected; the message is meant for the user."""
+
+
+class InvalidCursorError(ValueError):
+    """Raised for pagination cursors that weren't built by encode_cursor()."""
+
+
+def image_extension(header: bytes) -> Optional[str]:
+    """Sniffs the format from the first bytes, ignoring the client's claims."""
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return ".webp"
+
+    for signature, extension in IMAGE_SIGNATURES.items():
+        if header.startswith(signature):
+            return extension
+
+    return None
+
+
+def owned_directory(storage_key: str) -> Optional[str]:
+    """Key of the directory an image's files live in, if it has one of its own.
+
+    Keys without a directory, or pointing outside the storage, give None so
+    that nothing but the image's own files is ever removed.
+    """
+    directory = path.normpath(path.dirname(storage_key))
+
+    if directory == "." or path.isabs(directory) or directory.startswith(".."):
+        return None
+
+    return directory
+
+
+def encode_cursor(image: db.Image) -> str:
+    """Encodes the sort key of an image into an opaque pagination cursor."""
+    key = json.dumps([image.created_at.isoformat(), image.id])
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(key[0]), int(key[1])
+    except (ValueError, TypeError, LookupError) as e:
+        raise InvalidCursorError(f"Invalid cursor: {cursor!r}") from e
+
+
+class ImageQueries:
+    """Builds the statements and results of the image listings.
+
+    Shared by ImageService and AsyncImageService, which only differ in how
+    the statements are executed.
+    """
+
+    def __init__(self, session):
         self.session = session
         self.config = config.get_config()
+        self.urls = UrlBuilder(self.config.image_base_url)
+
+    def _page_statements(self, page_no: int, page_size: int, category: str):
+        count_statement = (
+            select(func.count()).select_from(db.Image).where(~db.Image.processing)
+        )
+        statement = select(db.Image).where(~db.Image.processing)
+
+        if category:
+            count_statement = count_statement.where(db.Image.category == category)
+            statement = statement.where(db.Image.category == category)
+
+        statement = (
+            statement.order_by(db.Image.created_at, db.Image.id)
+            .offset((page_no - 1) * page_size)
+            .limit(page_size)
+        )
+
+        return count_statement, statement
+
+    def _page(self, page_no: int, page_size: int, total: int, images: list):
+        total_pages = (total + page_size - 1) // page_size
+        has_next = page_no < total_pages
+
+        return {
+            "page_no": page_no,
+            "page_size": page_size,
+            "total": total,
+            "total_pages": total_pages,
+            "has_next": has_next,
+            "has_previous": page_no > 1,
+            "next_cursor": encode_cursor(images[-1]) if has_next else None,
+            "content": [self._to_dto(image) for image in images],
+        }
+
+    def _page_after_statement(
+        self,
+        cursor: str,
+        page_size: int,
+        category: str,
+        include_processing: bool,
+    ):
+        statement = select(db.Image)
+
+        if not include_processing:
+            statement = statement.where(~db.Image.processing)
+
+        if category:
+            statement = statement.where(db.Image.category == category)
+
+        if cursor:
+            created_at, image_id = decode_cursor(cursor)
+            statement = statement.where(
+                tuple_(db.Image.created_at, db.Image.id) > tuple_(created_at, image_id)
+            )
+
+        # Fetch one extra row to find out whether there is a next page
+        return statement.order_by(db.Image.created_at, db.Image.id).limit(
+            page_size + 1
+        )
+
+    def _page_after(self, cursor: str, page_size: int, images: list):
+        has_next = len(images) > page_size
+        images = images[:page_size]
+
+        return {
+            "page_no": None,
+            "page_size": page_size,
+            "total": None,
+            "total_pages": None,
+            "has_next": has_next,
+            "has_previous": bool(cursor),
+            "next_cursor": encode_cursor(images[-1]) if has_next else None,
+            "content": [self._to_dto(image) for image in images],
+        }
+
+    def _categories_statement(self):
+        # Reads one row per category instead of scanning the images
+        return (
+            select(db.CategoryCount.category, db.CategoryCount.count)
+            .where(db.CategoryCount.count > 0)
+            .order_by(db.CategoryCount.category)
+        )
+
+    def _to_dto(self, image: db.Image) -> dto.ImageDTO:
+        return dto.ImageDTO(
+            id=image.id,
+            title=image.title,
+            description=image.description,
+            category=image.category,
+            image_url=self.urls.url(image.storage_key),
+            thumbnail_url=self.urls.url(image.thumbnail_key),
+            srcset=self.urls.srcset(image.renditions),
+            processing=image.processing,
+        )
+
+
+class ImageService(ImageQueries):
+    def __init__(self, session: Annotated[Session, Depends(db.session)]):
+        super().__init__(session)
+
+    @property
+    def storage(self) -> Storage:
+        return get_storage(self.config)
 
     def get_image(self, image_id):
         statement = select(db.Image).where(db.Image.id == image_id)
         result = self.session.exec(statement)
         return result.one_or_none()
 
-    def get_images(self):
-        statement = select(db.Image)
-        result = self.session.exec(statement)
-        return result.all()
-
     def save(self, image: db.Image, image_file: Optional[UploadFile]):
-        img_path = ""
-        thumbnail_img_path = ""
+        with self._reserve(image_file) as reservation:
+            submit = self.stage(image, image_file)
+            self.session.commit()
+            response_cache.invalidate()
 
-        if image_file and image_file.filename != "":
-            uuid = uuid4()
-            image_dir = path.join(self.config.image_directory, str(uuid))
+            if submit:
+                worker.submit(image, self.config, reservation)
 
-            logging.info(f"Saving image to {image_dir}")
-
-            os.makedirs(image_dir, exist_ok=True)
-
-            thumbnail_img_path = path.join(image_dir, "thumbnail.jpg")
-            img_path = path.join(image_dir, image_file.filename)
+        return image
 
-            with open(img_path, mode="w+b") as i:
-                i.write(image_file.file.read())
+    def stage(self, image: db.Image, image_file: Optional[UploadFile]) -> bool:
+        """Stores the upload and adds the image to the session, uncommitted.
 
-            with Image.open(img_path) as img:
-                width, height = img.size
-                new_size = (width // 10, height // 10)
-                thumbnail_img = img.copy()
-                thumbnail_img.thumbnail(new_size)
-                thumbnail_img.save(thumbnail_img_path)
+        Returns True if the renditions still need to be generated; it is up
+        to the caller to submit them to the worker after committing. This
+        lets bulk imports commit many images at once.
+        """
+        submit = False
 
-        if img_path:
-            image.url = img_path
+        if image_file and image_file.filename != "":
+            key = self._store(image_file)
+            submit = self._point_to(image, key)
 
-        if thumbnail_img_path:
-            image.thumbnail_url = thumbnail_img_path
+        if image.id is None and not image.processing:
+            db.count_category(self.session, image.category, 1)
 
         image.created_at = image.created_at or datetime.now()
         image.updated_at = datetime.now()
 
         self.session.add(image)
-        self.session.commit()
+        return submit
+
+    def update(
+        self,
+        image: db.Image,
+        title: str,
+        description: str,
+        category: str,
+        image_file: Optional[UploadFile],
+    ):
+        """Applies an edit, touching only what actually changed.
+
+        Re-uploading the current file is detected by its hash and neither
+        stored nor processed again. Files replaced by a new upload are
+        removed once no other image references them.
+        """
+        superseded_dir = None
+        submit = False
+        old_category = image.category
+        old_processing = image.processing
+
+        with self._reserve(image_file) as reservation:
+            # Nothing may be flushed early, so is_modified sees all changes
+            with self.session.no_autoflush:
+                if image_file and image_file.filename != "":
+                    key = self._store(image_file, current_hash=image.content_hash)
+
+                    if key:
+                        # Legacy images without a hash own their directory
+                        if not image.content_hash or self._release_blob(
+                            image.content_hash
+                        ):
+                            superseded_dir = owned_directory(image.storage_key)
+
+                        submit = self._point_to(image, key)
+
+                image.title = title
+                image.description = description
+                image.category = category
+
+                if not self.session.is_modified(image):
+                    return image
+
+            image.updated_at = datetime.now()
+
+            if (category, image.processing) != (old_category, old_processing):
+                if not old_processing:
+                    db.count_category(self.session, old_category, -1)
+                if not image.processing:
+                    db.count_category(self.session, category, 1)
+
+            # Only the modified columns end up in the UPDATE statement
+            self.session.add(image)
+            self.session.commit()
+            response_cache.invalidate()
+
+            if superseded_dir:
+                self.storage.delete_directory(superseded_dir)
+
+            if submit:
+                worker.submit(image, self.config, reservation)
 
         return image
 
+    def _reserve(self, image_file: Optional[UploadFile]):
+        """Reserves room in the worker pool before an upload is stored.
+
+        Raises worker.Saturated right away, instead of accepting an upload
+        that would then wait for processing indefinitely.
+        """
+        if image_file and image_file.filename != "":
+            return worker.reserve()
+
+        return nullcontext()
+
+    def _point_to(self, image: db.Image, key: str) -> bool:
+        """Points the image at a stored original.
+
+        Returns True if its renditions still need to be generated.
+        """
+        image.storage_key = key
+        image.content_hash = path.basename(path.dirname(key))
+
+        # Identical bytes may have been uploaded and processed before
+        statement = (
+            select(db.Image)
+            .where(db.Image.content_hash == image.content_hash)
+            .where(~db.Image.processing)
+            .limit(1)
+            # The worker updates rows outside of this session
+            .execution_options(populate_existing=True)
+        )
+        processed = self.session.exec(statement).first()
+
+        if processed:
+            image.thumbnail_key = processed.thumbnail_key
+            image.renditions = processed.renditions
+            image.processing = False
+            return False
+
+        # Thumbnail and renditions are generated in the background
+        image.thumbnail_key = None
+        image.renditions = None
+        image.processing = True
+        return True
+
+    def _store(
+        self, image_file: UploadFile, current_hash: Optional[str] = None
+    ) -> Optional[str]:
+        """Stores the upload under its content hash and returns its key.
+
+        Returns None if the upload has the current_hash, i.e. is unchanged.
+        The blob's reference count is increased in the current transaction,
+        so that it is only persisted together with the referencing image.
+        """
+        storage = self.storage
+        tmp_path = storage.staging_path(".upload-")
+
+        try:
+            content_hash, extension = self._write_upload(image_file, tmp_path)
+
+            if content_hash == current_hash:
+                logging.info(f"Image {content_hash} is unchanged")
+                return None
+
+            key = path.join(storage_directory(content_hash), "original" + extension)
+
+            if self._acquire_blob(content_hash):
+                logging.info(f"Saving image to {key}")
+
+                storage.put(key, tmp_path)
+            else:
+                logging.info(f"Image already stored in {key}")
+
+                # Blobs stored flat are only moved by shard_storage.py
+                unsharded_key = path.join(content_hash, "original" + extension)
+                if not storage.exists(key) and storage.exists(unsharded_key):
+                    key = unsharded_key
+        finally:
+            if path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        return key
+
+    def _write_upload(self, image_file: UploadFile, img_path: str):
+        """Copies the upload to disk chunk by chunk and validates it on the way.
+
+        Raises InvalidImageError as soon as the upload turns out to be too
+        large or not an image, without reading the rest of it. Returns the
+        SHA-256 of the content and the file extension of its format.
+        """
+        if image_file.size and image_file.size > self.config.max_upload_size:
+            raise InvalidImageError("The image is too large")
+
+        size = 0
+        extension = None
+        content_hash = hashlib.sha256()
+
+        with open(img_path, mode="w+b") as i:
+            while chunk := image_file.file.read(CHUNK_SIZE):
+                if size == 0:
+                    extension = image_extension(chunk)
+
+                    if extension is None:
+                        raise InvalidImageError("The file is not a supported image")
+
+                size += len(chunk)
+
+                if size > self.config.max_upload_size:
+                    raise InvalidImageError("The image is too large")
+
+                content_hash.update(chunk)
+                i.write(chunk)
+
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("error", Image.DecompressionBombWarning)
+
+                # Only reads the header, the pixels are decoded by the worker
+                with Image.open(img_path) as img:
+                    width, height = img.size
+        except (Image.DecompressionBombError, Image.DecompressionBombWarning):
+            raise InvalidImageError("The image is too large")
+        except Exception:
+            raise InvalidImageError("The file is not a supported image")
+
+        if width * height > self.config.max_image_pixels:
+            raise InvalidImageError("The image is too large")
+
+        return content_hash.hexdigest(), extension
+
+    def _acquire_blob(self, content_hash: str) -> bool:
+        """Adds a reference to a blob; returns True if the blob is new."""
+        statement = (
+            update(db.Blob)
+            .where(db.Blob.content_hash == content_hash)
+            .values(ref_count=db.Blob.ref_count + 1)
+        )
+
+        if self.session.exec(statement).rowcount > 0:
+            return False
+
+        try:
+            # Another upload of the same content may insert it concurrently
+            with self.session.begin_nested():
+                self.session.add(
+                    db.Blob(content_hash=content_hash, created_at=datetime.now())
+                )
+        except IntegrityError:
+            self.session.exec(statement)
+            return False
+
+        return True
+
+    def _release_blob(self, content_hash: str) -> bool:
+        """Drops a reference to a blob; returns True if it was the last one."""
+        statement = (
+            update(db.Blob)
+            .where(db.Blob.content_hash == content_hash)
+            .values(ref_count=db.Blob.ref_count - 1)
+        )
+        self.session.exec(statement)
+
+        blob = self.session.get(db.Blob, content_hash, populate_existing=True)
+
+        if blob is None or blob.ref_count > 0:
+            return False
+
+        self.session.delete(blob)
+        return True
+
     def delete(self, image_id: int):
         statement = select(db.Image).where(db.Image.id == image_id)
         result = self.session.exec(statement)
         image = result.one()
         self.session.delete(image)
+
+        if not image.processing:
+            db.count_category(self.session, image.category, -1)
+
+        # Legacy images without a content hash own their directory
+        remove_files = (
+            self._release_blob(image.content_hash) if image.content_hash else True
+        )
+
         self.session.commit()
+        response_cache.invalidate()
+
+        directory = owned_directory(image.storage_key)
 
-        shutil.rmtree(path.dirname(image.url))
+        if remove_files and directory:
+            self.storage.delete_directory(directory)
 
         return image
 
     def get_image_page(self, page_no: int, page_size: int, category: str):
-        statement = (
-            select(db.Image).where(db.Image.category == category)
-            if category
-            else select(db.Image)
+        count_statement, statement = self._page_statements(
+            page_no, page_size, category
         )
+        total = self.session.exec(count_statement).one()
+        images = self.session.exec(statement).all()
 
-        result = self.session.exec(statement)
-        images = result.all()
+        return self._page(page_no, page_size, total, images)
 
-        total = len(images)
-        total_pages = (total + page_size - 1) // page_size
-        has_next = page_no < total_pages
-        has_previous = page_no > 1
+    def get_image_page_after(
+        self,
+        cursor: str,
+        page_size: int,
+        category: str,
+        include_processing: bool = False,
+    ):
+        """Keyset pagination: returns the images following the cursor.
 
-        start_index = (page_no - 1) * page_size
-        end_index = start_index + page_size
-        images = images[start_index:end_index]
+        Unlike get_image_page this never counts or skips rows, so the cost
+        stays the same no matter how deep the client has scrolled.
+        """
+        statement = self._page_after_statement(
+            cursor, page_size, category, include_processing
+        )
+        images = self.session.exec(statement).all()
 
-        content: List[dto.ImageDTO] = []
+        return self._page_after(cursor, page_size, images)
 
-        for image in images:
-            image.url = image.url.replace(
-                self.config.image_directory, self.config.gallery_endpoint
-            )
-            image.thumbnail_url = image.thumbnail_url.replace(
-                self.config.image_directory, self.config.gallery_endpoint
-            )
+    def get_categories(self) -> List[tuple[str, int]]:
+        """Returns the categories in use along with their image counts."""
+        return list(self.session.exec(self._categories_statement()).all())
 
-            content.append(
-                dto.ImageDTO(
-                    id=image.id,
-                    title=image.title,
-                    description=image.description,
-                    category=image.category,
-                    image_url=image.url,
-                    thumbnail_url=image.thumbnail_url,
-                )
-            )
 
-        return {
-            "page_no": page_no,
-            "page_size": page_size,
-            "total": total,
-            "total_pages": total_pages,
-            "has_next": has_next,
-            "has_previous": has_previous,
-            "content": content,
-        }
-        
-    def get_categories(self) -> List[str]:
-        statement = select(db.Image.category).distinct()
-        result = self.session.exec(statement)
-        categories = result.all()
+class AsyncImageService(ImageQueries):
+    """The read side of ImageService, for async endpoints."""
 
-        return [category for category in categories]
+    def __init__(self, session: Annotated[AsyncSession, Depends(db.async_session)]):
+        super().__init__(session)
+
+    async def get_image_page(self, page_no: int, page_size: int, category: str):
+        count_statement, statement = self._page_statements(
+            page_no, page_size, category
+        )
+        total = (await self.session.exec(count_statement)).one()
+        images = (await self.session.exec(statement)).all()
+
+        return self._page(page_no, page_size, total, images)
+
+    async def get_image_page_after(
+        self,
+        cursor: str,
+        page_size: int,
+        category: str,
+        include_processing: bool = False,
+    ):
+        statement = self._page_after_statement(
+            cursor, page_size, category, include_processing
+        )
+        images = (await self.session.exec(statement)).all()
+
+        return self._page_after(cursor, page_size, images)
+
+    async def get_categories(self) -> List[tuple[str, int]]:
+        return list((await self.session.exec(self._categories_statement())).all())
 
 
 class UserService:
     def __init__(self, session: Annotated[Session, Depends(db.session)]):
         self.session = session
-        self.ph = PasswordHasher()
+        self.ph = password_hasher
 
     def get_user(self, username: str):
         statement = select(db.User).where(db.User.username == username)
@@ -173,11 +594,9 @@ class AuthService:
         user_service: Annotated[UserService, Depends()],
         config: Annotated[config.Config, Depends(config.get_config)],
     ):
-        self.serializer = URLSafeSerializer(
-            config.auth.secret_token, salt=config.auth.salt
-        )
+        self.serializer = token_serializer(config.auth.secret_token, config.auth.salt)
         self.user_service = user_service
-        self.ph = PasswordHasher()
+        self.ph = password_hasher
 
     def verify(self, username: str, password: str) -> bool:
         user = self.user_service.get_user(username)
@@ -211,3 +630,21 @@ class AuthService:
             return username
         except Exception:
             return None
+
+
+@lru_cache
+def token_serializer(secret_token: str, salt: str) -> URLSafeSerializer:
+    return URLSafeSerializer(secret_token, salt=salt)
+
+
+def is_authenticated(request: Request, auth: Annotated[AuthService, Depends()]):
+    """Returns the username of a valid session cookie, or False.
+
+    As a dependency it is resolved once per request, however many of the
+    endpoint's dependencies need it.
+    """
+    token = request.cookies.get("gallery")
+
+    if token:
+        return auth.verify_token(token)
+    return False
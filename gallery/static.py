@@ -0,0 +1,103 @@
+import hashlib
+import os
+import re
+import stat
+from os import path
+
+import anyio
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse
+from starlette.types import Scope
+
+from gallery.worker import JPEG, negotiate_format
+
+CONTENT_HASH = re.compile(r"[0-9a-f]{64}")
+
+# A year, the longest lifetime caches are expected to honor
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+class ImageFiles(StaticFiles):
+    """Serves stored images with long-lived caching.
+
+    Every file lives in a directory of its own that is never reused for
+    other content, so its URL is immutable and browsers and proxies may
+    keep it for good. Conditional requests are answered with a 304 based
+    on an ETag derived from the file's key, size and modification time.
+
+    Renditions are requested by their JPEG URL, but served in the best
+    format the client accepts, if that variant exists.
+    """
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        if not is_rendition(path):
+            return await super().get_response(path, scope)
+
+        rendition_format = negotiate_format(Headers(scope=scope).get("accept", ""))
+
+        response = None
+        if rendition_format != JPEG:
+            variant = path.removesuffix(JPEG.extension) + rendition_format.extension
+            full_path, stat_result = await anyio.to_thread.run_sync(
+                self.lookup_path, variant
+            )
+
+            if stat_result and stat.S_ISREG(stat_result.st_mode):
+                response = self.file_response(full_path, stat_result, scope)
+
+        if response is None:
+            response = await super().get_response(path, scope)
+
+        response.headers["vary"] = "Accept"
+        return response
+
+    def file_response(
+        self,
+        full_path: str | os.PathLike,
+        stat_result: os.stat_result,
+        scope: Scope,
+        status_code: int = 200,
+    ) -> Response:
+        request_headers = Headers(scope=scope)
+
+        response = FileResponse(
+            full_path, status_code=status_code, stat_result=stat_result
+        )
+        response.headers["etag"] = file_etag(
+            path.relpath(full_path, self.directory),
+            stat_result.st_mtime_ns,
+            stat_result.st_size,
+        )
+        response.headers["cache-control"] = IMMUTABLE_CACHE_CONTROL
+
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+
+        return response
+
+
+def is_rendition(file_path: str) -> bool:
+    return (
+        file_path.endswith(JPEG.extension)
+        and path.basename(path.dirname(file_path)).startswith("renditions")
+    )
+
+
+def file_etag(key: str, mtime_ns: int, size: int) -> str:
+    """Strong ETag of a stored file, without reading it.
+
+    Files are never changed in place, so their key, size and modification
+    time identify the content.
+    """
+    image_dir, filename = path.split(key)
+
+    # Originals are stored in a directory named after their SHA-256
+    if filename.startswith("original.") and CONTENT_HASH.fullmatch(
+        path.basename(image_dir)
+    ):
+        return f'"{path.basename(image_dir)}"'
+
+    version = hashlib.sha256(f"{key}:{size}:{mtime_ns}".encode()).hexdigest()
+    return f'"{version[:32]}"'
@@ -0,0 +1,205 @@
+"""Where stored images live and under which URL they are served.
+
+Images are recorded by storage keys, e.g. ab/cd/<hash>/original.jpg, so that
+neither the location of the storage nor the public URL ends up in the
+database. The storage is either a local directory or an S3-compatible
+bucket, see get_storage().
+"""
+
+import os
+import shutil
+import tempfile
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from functools import lru_cache
+from os import path
+from typing import ContextManager, Iterator, List, Optional
+from uuid import uuid4
+
+import gallery.config as config
+
+# Parts of large S3 uploads are sent one by one instead of all at once
+MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def storage_directory(name: str) -> str:
+    """Key of the directory of a stored image, fanned out as ab/cd/abcd.../.
+
+    Keeps every directory small, however many images are stored.
+    """
+    return f"{name[:2]}/{name[2:4]}/{name}"
+
+
+def storage_path(image_directory: str, key: str) -> str:
+    return path.join(image_directory, key)
+
+
+def storage_key(image_directory: str, file_path: str) -> str:
+    return path.relpath(file_path, image_directory)
+
+
+class Storage(ABC):
+    """Stores files under keys.
+
+    Files are prepared locally in the staging_directory, e.g. to hash or
+    resize them, and are then handed over with put(). Instances are
+    passed to worker processes, so they have to be picklable.
+    """
+
+    staging_directory: str
+
+    def staging_path(self, prefix: str) -> str:
+        return path.join(self.staging_directory, f"{prefix}{uuid4()}")
+
+    @abstractmethod
+    def put(self, key: str, file_path: str) -> None:
+        """Moves a local file into the storage, replacing any file under key."""
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        pass
+
+    @abstractmethod
+    def delete_directory(self, key: str) -> None:
+        """Deletes all files below a key, if there are any."""
+
+    @abstractmethod
+    def local_path(self, key: str) -> ContextManager[str]:
+        """Provides the file under key on the local file system, for reading."""
+
+    def redirect_url(self, key: str) -> Optional[str]:
+        """URL clients are sent to for a file, if it isn't served by the app."""
+        return None
+
+
+class LocalStorage(Storage):
+    """Stores files below a local directory, served by gallery.static.ImageFiles."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        # On the same file system, so files are moved in with a rename
+        self.staging_directory = directory
+
+    def put(self, key: str, file_path: str) -> None:
+        target = storage_path(self.directory, key)
+        os.makedirs(path.dirname(target), exist_ok=True)
+        os.replace(file_path, target)
+
+    def exists(self, key: str) -> bool:
+        return path.exists(storage_path(self.directory, key))
+
+    def delete_directory(self, key: str) -> None:
+        root = path.realpath(self.directory)
+        target = path.realpath(storage_path(self.directory, key))
+
+        if path.commonpath([root, target]) != root or target == root:
+            raise ValueError(f"Not a directory below the storage: {key!r}")
+
+        shutil.rmtree(target, ignore_errors=True)
+
+    @contextmanager
+    def local_path(self, key: str) -> Iterator[str]:
+        yield storage_path(self.directory, key)
+
+
+class S3Storage(Storage):
+    """Stores files in an S3-compatible bucket, e.g. on AWS or MinIO.
+
+    Requires boto3. Clients are redirected to presigned URLs instead of the
+    app serving the files, so any number of app instances can share the
+    bucket. Credentials are taken from the usual AWS environment variables.
+    """
+
+    def __init__(self, bucket: str, endpoint_url: Optional[str], url_expiry: int):
+        self.bucket = bucket
+        self.endpoint_url = endpoint_url
+        self.url_expiry = url_expiry
+        self.staging_directory = tempfile.gettempdir()
+
+    @property
+    def client(self):
+        return _s3_client(self.endpoint_url)
+
+    def put(self, key: str, file_path: str) -> None:
+        from boto3.s3.transfer import TransferConfig
+
+        transfer_config = TransferConfig(
+            multipart_threshold=MULTIPART_CHUNK_SIZE,
+            multipart_chunksize=MULTIPART_CHUNK_SIZE,
+        )
+
+        self.client.upload_file(file_path, self.bucket, key, Config=transfer_config)
+        os.remove(file_path)
+
+    def exists(self, key: str) -> bool:
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return False
+            raise
+
+        return True
+
+    def delete_directory(self, key: str) -> None:
+        paginator = self.client.get_paginator("list_objects_v2")
+
+        # Pages hold up to 1000 keys, as many as one request may delete
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=key + "/"):
+            objects = [{"Key": o["Key"]} for o in page.get("Contents", [])]
+
+            if objects:
+                self.client.delete_objects(
+                    Bucket=self.bucket, Delete={"Objects": objects, "Quiet": True}
+                )
+
+    @contextmanager
+    def local_path(self, key: str) -> Iterator[str]:
+        local_path = self.staging_path(".download-")
+
+        try:
+            self.client.download_file(self.bucket, key, local_path)
+            yield local_path
+        finally:
+            if path.exists(local_path):
+                os.remove(local_path)
+
+    def redirect_url(self, key: str) -> Optional[str]:
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": key},
+            ExpiresIn=self.url_expiry,
+        )
+
+
+@lru_cache
+def _s3_client(endpoint_url: Optional[str]):
+    # Clients are thread-safe and expensive to create, one per process
+    import boto3
+
+    return boto3.client("s3", endpoint_url=endpoint_url)
+
+
+def get_storage(config: config.Config) -> Storage:
+    if config.storage_backend == "s3":
+        return S3Storage(config.s3_bucket, config.s3_endpoint_url, config.s3_url_expiry)
+
+    return LocalStorage(config.image_directory)
+
+
+class UrlBuilder:
+    """Builds the public URLs of stored images, e.g. on a CDN."""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip("/")
+
+    def url(self, key: Optional[str]) -> Optional[str]:
+        return key and f"{self.base_url}/{key}"
+
+    def srcset(self, renditions: Optional[List[dict]]) -> Optional[str]:
+        if not renditions:
+            return None
+
+        return ", ".join(f"{self.url(r['key'])} {r['width']}w" for r in renditions)
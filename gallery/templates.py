@@ -1,41 +1,115 @@
 import gettext
+import logging
+import os
+import time
 from datetime import datetime
+from functools import lru_cache
 from typing import Annotated
 
 from fastapi import Depends, Request
 from fastapi.templating import Jinja2Templates
+from jinja2 import FileSystemBytecodeCache
 
-from gallery.service import AuthService as Auth
+import gallery.config as config
+from gallery.service import is_authenticated
 
 templates = Jinja2Templates(directory="templates")
 
+# The first one is used if the client accepts none of them
+LANGUAGES = ["en", "de"]
+
+# Parsed once, every request shares them
+catalogs = {
+    language: gettext.translation("base", "locales", languages=[language])
+    for language in LANGUAGES
+}
+
+
+def init(config: config.Config) -> None:
+    """Sets up the template environment before the first request.
+
+    Compiled templates are kept in template_cache_directory, so restarted
+    workers load them instead of compiling them again. In production the
+    templates don't change while running, so they aren't checked for
+    changes on every render.
+    """
+    os.makedirs(config.template_cache_directory, exist_ok=True)
+
+    templates.env.bytecode_cache = FileSystemBytecodeCache(
+        config.template_cache_directory
+    )
+    templates.env.auto_reload = not config.mode.is_prod()
+
+    if config.template_warm_up:
+        warm_up()
+
+
+def warm_up() -> None:
+    """Loads all templates, so no request has to wait for them."""
+    started = time.perf_counter()
+    names = templates.env.list_templates(extensions=["jinja"])
+
+    for name in names:
+        templates.env.get_template(name)
+
+    elapsed = (time.perf_counter() - started) * 1000
+    logging.info(f"Loaded {len(names)} templates in {elapsed:.0f}ms")
+
+
+@lru_cache(maxsize=256)
+def negotiate_language(accept_language: str) -> str:
+    """Picks the supported language the client prefers, by q-value.
+
+    Takes an Accept-Language header, e.g. "de-CH,de;q=0.9,en;q=0.8", or a
+    single language. Clients send the same few headers over and over, so
+    the results are memoized.
+    """
+    best, best_q = LANGUAGES[0], 0.0
+
+    for entry in accept_language.split(","):
+        tag, *params = entry.strip().split(";")
+        language = tag.strip().lower().split("-")[0]
+        q = 1.0
+
+        for param in params:
+            name, _, value = param.strip().partition("=")
+
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+
+        if language == "*":
+            language = LANGUAGES[0]
+
+        # The first of equally preferred languages wins
+        if language in LANGUAGES and q > best_q:
+            best, best_q = language, q
+
+    return best
+
 
 class TemplateRenderer:
-    def __init__(self, request: Request, auth: Annotated[Auth, Depends()]):
-        self.auth = auth
+    def __init__(
+        self,
+        request: Request,
+        is_authenticated: Annotated[bool, Depends(is_authenticated)],
+    ):
+        # Shared with the endpoint, the token is only verified once
+        self.is_authenticated = bool(is_authenticated)
         self.request = request
         lang = self.request.query_params.get("lang") or self.request.headers.get(
-            "accept-language"
+            "accept-language", ""
         )
 
-        if lang and "de" in lang:
-            lang = "de"
-        else:
-            lang = "en"
-
-        self.language_translations = gettext.translation(
-            "base", "locales", languages=[lang]
-        )
+        self.language = negotiate_language(lang)
+        self.language_translations = catalogs[self.language]
 
     def render(self, name: str, context: dict):
         context["_"] = self.translate
-        context["is_authenticated"] = False
+        context["is_authenticated"] = self.is_authenticated
         context["year"] = datetime.now().year
-        if self.request.cookies.get("gallery"):
-            token = self.request.cookies.get("gallery")
-            username = self.auth.verify_token(token)
-            if username:
-                context["is_authenticated"] = True
 
         return templates.TemplateResponse(
             request=self.request, name=name, context=context
@@ -0,0 +1,404 @@
+import hashlib
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from functools import lru_cache
+from os import path
+from typing import List, NamedTuple
+
+from PIL import Image
+from sqlalchemy import text, update
+from sqlmodel import Session, select
+
+import gallery.config as config
+import gallery.db as db
+import gallery.response_cache as response_cache
+from gallery.storage import Storage, get_storage
+
+executor = None
+pool_options: dict = {}
+_pool_lock = threading.Lock()
+# Held by the process requeueing the pending images, see resume_pending()
+RESUME_LOCK = 0x67616C6C
+# Bounds the jobs that are running or waiting for a free process
+slots = threading.BoundedSemaphore(1)
+
+
+class Saturated(Exception):
+    """Raised when the pool can't take another job right now."""
+
+
+class RenditionFormat(NamedTuple):
+    name: str
+    extension: str
+    media_type: str
+    options: dict
+
+
+Image.init()
+
+# Most preferred first when negotiating with clients; AVIF depends on the
+# Pillow build. JPEG comes last as every client supports it.
+RENDITION_FORMATS = [
+    f
+    for f in (
+        RenditionFormat("AVIF", ".avif", "image/avif", {"quality": 60}),
+        RenditionFormat("WEBP", ".webp", "image/webp", {"quality": 80}),
+        RenditionFormat("JPEG", ".jpg", "image/jpeg", {"quality": 85}),
+    )
+    if f.name in Image.SAVE
+]
+JPEG = RENDITION_FORMATS[-1]
+
+
+@lru_cache(maxsize=256)
+def negotiate_format(accept: str) -> RenditionFormat:
+    """Picks the best rendition format the Accept header allows, by q-value.
+
+    Newer formats have to be listed explicitly, as clients accepting */*
+    can't necessarily decode them; JPEG is served to everyone else. Of
+    equally preferred formats the most preferred in RENDITION_FORMATS wins.
+    """
+    qualities = {}
+
+    for entry in accept.split(","):
+        media_type, *params = entry.strip().split(";")
+        q = 1.0
+
+        for param in params:
+            name, _, value = param.strip().partition("=")
+
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+
+        qualities[media_type.strip().lower()] = q
+
+    jpeg_q = qualities.get(
+        JPEG.media_type, qualities.get("image/*", qualities.get("*/*", 0.0))
+    )
+    best, best_q = JPEG, jpeg_q
+
+    for f in RENDITION_FORMATS[:-1]:
+        q = qualities.get(f.media_type, 0.0)
+
+        if q > 0 and q >= best_q and (best is JPEG or q > best_q):
+            best, best_q = f, q
+
+    return best
+
+
+def init(config: config.Config) -> None:
+    """Starts the process pool that generates image derivatives.
+
+    At most image_workers jobs run at once and image_queue_size more may
+    wait; beyond that jobs are rejected with Saturated. In test mode no
+    pool is started and jobs run inline, so tests can assert on the
+    result right after saving.
+    """
+    global executor, slots, pool_options
+
+    _init_process(config.max_image_pixels)
+
+    slots = threading.BoundedSemaphore(config.image_workers + config.image_queue_size)
+
+    if not config.mode.is_test():
+        pool_options = {
+            "max_workers": config.image_workers,
+            "initializer": _init_process,
+            "initargs": (config.max_image_pixels,),
+        }
+        executor = ProcessPoolExecutor(**pool_options)
+
+
+def _restart_pool(broken: ProcessPoolExecutor) -> ProcessPoolExecutor:
+    """Replaces a pool that lost a process, e.g. killed for using too much memory.
+
+    Such a pool rejects all further jobs.
+    """
+    global executor
+
+    with _pool_lock:
+        if executor is broken:
+            logging.warning("Image processing pool is broken, starting a new one")
+            broken.shutdown(wait=False)
+            executor = ProcessPoolExecutor(**pool_options)
+
+        return executor
+
+
+def _init_process(max_image_pixels: int) -> None:
+    # Pillow refuses to decode images above twice this limit
+    Image.MAX_IMAGE_PIXELS = max_image_pixels
+
+
+def rendition_directory(key: str, widths: List[int]) -> str:
+    """Directory holding the image's renditions for the current settings.
+
+    Its name changes with the widths and formats, so regenerated
+    renditions never replace files that clients may have cached for good.
+    """
+    settings = repr(
+        (sorted(widths), [(f.name, sorted(f.options.items())) for f in RENDITION_FORMATS])
+    )
+    version = hashlib.sha256(settings.encode()).hexdigest()[:8]
+
+    return path.join(path.dirname(key), f"renditions-{version}")
+
+
+def create_renditions(storage: Storage, key: str, widths: List[int]) -> List[dict]:
+    """Writes a copy of the stored image for each width, decoding it only once.
+
+    Every rendition is encoded in all RENDITION_FORMATS; the recorded key
+    is the JPEG one, the others are picked by content negotiation. Widths
+    larger than the original are skipped; an image smaller than every
+    width gets a single rendition at its own size.
+    """
+    rendition_dir = rendition_directory(key, widths)
+    renditions = []
+
+    with storage.local_path(key) as img_path, Image.open(img_path) as img:
+        original_width, original_height = img.size
+        fitting_widths = [w for w in widths if w < original_width] or [original_width]
+
+        # JPEGs can be decoded at 1/2 to 1/8 scale right away, as long as
+        # the result is still at least as large as the largest rendition
+        largest_width = max(fitting_widths)
+        largest_height = round(original_height * largest_width / original_width)
+        img.draft("RGB", (largest_width, largest_height))
+
+        rendition = _resamplable(img)
+
+        # Largest first, so every step resizes the previous, smaller copy
+        for width in sorted(fitting_widths, reverse=True):
+            height = max(1, round(original_height * width / original_width))
+            rendition = rendition.resize(
+                (width, height), Image.Resampling.LANCZOS, reducing_gap=3.0
+            )
+
+            rgb_rendition = rendition.convert("RGB")
+
+            for f in RENDITION_FORMATS:
+                variant_key = path.join(rendition_dir, f"{width}{f.extension}")
+                variant_path = storage.staging_path(".rendition-")
+
+                rgb_rendition.save(variant_path, format=f.name, **f.options)
+                storage.put(variant_key, variant_path)
+
+            rendition_key = path.join(rendition_dir, f"{width}{JPEG.extension}")
+            renditions.append({"width": width, "key": rendition_key})
+
+    return sorted(renditions, key=lambda r: r["width"])
+
+
+def create_resized(
+    storage: Storage,
+    key: str,
+    width: int,
+    resized_path: str,
+    format: RenditionFormat = JPEG,
+) -> None:
+    """Writes a copy of the stored image at the given width, never upscaling."""
+    with storage.local_path(key) as img_path, Image.open(img_path) as img:
+        original_width, original_height = img.size
+        width = min(width, original_width)
+        height = max(1, round(original_height * width / original_width))
+
+        img.draft("RGB", (width, height))
+
+        resized = _resamplable(img).resize(
+            (width, height), Image.Resampling.LANCZOS, reducing_gap=3.0
+        )
+        resized.convert("RGB").save(resized_path, format=format.name, **format.options)
+
+
+def _resamplable(img: Image.Image) -> Image.Image:
+    if img.mode in ("1", "P"):
+        # Palette images can't be resampled, only scaled nearest neighbor
+        return img.convert("RGBA")
+
+    return img
+
+
+class Reservation:
+    """Room for one job in the pool, see reserve()."""
+
+    def __init__(self):
+        self.used = False
+
+    def submit(self, fn, *args) -> Future:
+        if executor is None:
+            future = Future()
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            pool = executor
+
+            try:
+                future = pool.submit(fn, *args)
+            except BrokenProcessPool:
+                future = _restart_pool(pool).submit(fn, *args)
+
+        self.used = True
+        future.add_done_callback(lambda _: slots.release())
+        return future
+
+
+@contextmanager
+def reserve(block: bool = False):
+    """Reserves room for a job before any work is done for it.
+
+    Raises Saturated if the pool is busy, unless block is set, in which
+    case it waits for room. The room is given back when the job submitted
+    through the reservation has finished, or right away if none was.
+    """
+    if not slots.acquire(blocking=block):
+        raise Saturated()
+
+    reservation = Reservation()
+
+    try:
+        yield reservation
+    finally:
+        if not reservation.used:
+            slots.release()
+
+
+def run(fn, *args):
+    """Runs a job in the pool and waits for its result."""
+    with reserve() as reservation:
+        future = reservation.submit(fn, *args)
+
+    return future.result()
+
+
+def submit(
+    image: db.Image, config: config.Config, reservation: Reservation
+) -> Future:
+    """Queues the renditions of an image for generation.
+
+    All images sharing its content are updated and leave the processing
+    state once the job has finished.
+    """
+    key = image.storage_key
+
+    if image.content_hash:
+        where = db.Image.content_hash == image.content_hash
+    else:
+        where = db.Image.id == image.id
+
+    future = reservation.submit(
+        create_renditions, get_storage(config), key, config.rendition_widths
+    )
+    future.add_done_callback(lambda f: _finish(key, where, f))
+    return future
+
+
+def shutdown() -> None:
+    """Waits for all queued jobs to finish and stops the pool."""
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+def start_resume(config: config.Config) -> None:
+    """Runs resume_pending without holding up the startup."""
+    if executor is None:
+        # Jobs run inline in test mode anyway
+        resume_pending(config)
+        return
+
+    threading.Thread(
+        target=resume_pending, args=(config,), name="resume-pending", daemon=True
+    ).start()
+
+
+def resume_pending(config: config.Config) -> None:
+    """Requeues images whose processing was interrupted, e.g. by a restart.
+
+    With several uvicorn workers only one of them does so: it holds an
+    advisory lock until the requeued jobs have finished, the others leave
+    the backlog to it.
+    """
+    with db.engine.connect() as connection:
+        if not _lock(connection, "pg_try_advisory_lock"):
+            logging.info("Pending images are resumed by another process")
+            return
+
+        try:
+            wait(_resume(config))
+        finally:
+            _lock(connection, "pg_advisory_unlock")
+
+
+def _lock(connection, function: str) -> bool:
+    # Other databases serve a single process, there is nothing to lock
+    if connection.dialect.name != "postgresql":
+        return True
+
+    locked = connection.execute(
+        text(f"SELECT {function}(:key)"), {"key": RESUME_LOCK}
+    ).scalar()
+    # The lock belongs to the session, it outlives the transaction
+    connection.commit()
+    return locked
+
+
+def _resume(config: config.Config) -> List[Future]:
+    with Session(db.engine) as session:
+        statement = select(db.Image).where(db.Image.processing)
+        images = session.exec(statement).all()
+
+    futures = []
+    submitted = set()
+
+    for image in images:
+        if image.content_hash in submitted:
+            continue
+
+        logging.info(f"Resuming processing of image {image.id}")
+
+        with reserve(block=True) as reservation:
+            futures.append(submit(image, config, reservation))
+
+        if image.content_hash:
+            submitted.add(image.content_hash)
+
+    return futures
+
+
+def _finish(key: str, where, future: Future) -> None:
+    try:
+        renditions = future.result()
+        values = {
+            "renditions": renditions,
+            "thumbnail_key": renditions[0]["key"],
+            "processing": False,
+        }
+    except Exception as e:
+        logging.error(f"Error processing image {key}: {e}")
+        # Shown without renditions instead of being retried on every
+        # restart, rethumbnail.py generates them once the cause is fixed
+        values = {"renditions": None, "thumbnail_key": None, "processing": False}
+
+    statement = (
+        update(db.Image)
+        .where(where, db.Image.processing)
+        .values(**values)
+        .returning(db.Image.category)
+    )
+
+    with Session(db.engine) as session:
+        # The images become visible in the gallery, and count from now on
+        for category, count in Counter(session.exec(statement).scalars()).items():
+            db.count_category(session, category, count)
+
+        session.commit()
+
+    response_cache.invalidate()
@@ -0,0 +1,155 @@
+"""Imports an existing directory tree of photos into the gallery.
+
+    python import_images.py /path/to/photos --category birthday
+
+Images go through the same storage and rendition logic as uploads. Every
+batch is committed at once, together with the paths of its files, so an
+interrupted import picks up where it stopped when run again.
+"""
+
+import argparse
+import logging
+import os
+import time
+from datetime import datetime
+from os import path
+from typing import Iterator, List
+
+from fastapi import UploadFile
+from sqlmodel import Session, select
+
+import alembic.config
+import gallery.config as config
+import gallery.db as db
+import gallery.response_cache as response_cache
+import gallery.worker as worker
+from gallery.service import ImageService, InvalidImageError
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp"}
+
+
+def find_images(directory: str) -> Iterator[str]:
+    """Yields the paths of all images below directory, relative to it."""
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+
+        for filename in sorted(files):
+            if path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+                yield path.relpath(path.join(root, filename), directory)
+
+
+def import_directory(
+    directory: str, category: db.Category, batch_size: int = 100
+) -> int:
+    """Imports all images below directory that weren't imported before.
+
+    Returns the number of imported images. Renditions are generated in the
+    worker pool while the next batch is read; call worker.shutdown() to
+    wait for them.
+    """
+    count = 0
+    started = time.monotonic()
+
+    with Session(db.engine) as session:
+        service = ImageService(session)
+        batch = []
+
+        for relative_path in find_images(directory):
+            batch.append(path.abspath(path.join(directory, relative_path)))
+
+            if len(batch) == batch_size:
+                count += _import_batch(service, category, batch)
+                batch = []
+                _report(count, started)
+
+        if batch:
+            count += _import_batch(service, category, batch)
+            _report(count, started)
+
+    return count
+
+
+def _import_batch(
+    service: ImageService, category: db.Category, batch: List[str]
+) -> int:
+    statement = select(db.ImportedFile.path).where(db.ImportedFile.path.in_(batch))
+    imported = set(service.session.exec(statement).all())
+    pending = []
+
+    for file_path in batch:
+        if file_path in imported:
+            continue
+
+        filename = path.basename(file_path)
+        image = db.Image(
+            title=path.splitext(filename)[0],
+            description="",
+            category=category,
+        )
+
+        with open(file_path, "rb") as file:
+            upload = UploadFile(
+                file=file, filename=filename, size=path.getsize(file_path)
+            )
+
+            try:
+                pending.append((image, service.stage(image, upload)))
+            except InvalidImageError as e:
+                logging.warning(f"Skipping {file_path}: {e}")
+
+        # Committed along with the image, so neither can exist without the other
+        service.session.add(db.ImportedFile(path=file_path, created_at=datetime.now()))
+
+    service.session.commit()
+    response_cache.invalidate()
+
+    # Identical files within the batch share a single job
+    submitted = set()
+
+    for image, submit in pending:
+        if submit and image.content_hash not in submitted:
+            with worker.reserve(block=True) as reservation:
+                worker.submit(image, service.config, reservation)
+
+            submitted.add(image.content_hash)
+
+    return len(pending)
+
+
+def _report(count: int, started: float) -> None:
+    elapsed = time.monotonic() - started
+    print(f"{count} images imported, {count / elapsed:.1f} images/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory", help="directory tree to import")
+    parser.add_argument(
+        "--category",
+        required=True,
+        choices=[c.value for c in db.Category],
+        help="category of the imported images",
+    )
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    gallery_config = config.get_config()
+    db.init(gallery_config)
+    response_cache.init(gallery_config)
+    alembic.config.main(argv=["upgrade", "head"])
+    worker.init(gallery_config)
+
+    started = time.monotonic()
+    count = import_directory(
+        args.directory, db.Category(args.category), args.batch_size
+    )
+
+    # Renditions may still be generated at this point
+    worker.shutdown()
+
+    elapsed = time.monotonic() - started
+    print(f"Done: {count} images in {elapsed:.1f}s, {count / elapsed:.1f} images/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,9 @@ import alembic.config
 import gallery.api as api
 import gallery.config as config
 import gallery.db as db
+import gallery.templates as templates
+import gallery.worker as worker
+from gallery.static import ImageFiles
 
 gallery_config = config.get_config()
 db.init(gallery_config)
@@ -21,14 +24,15 @@ alembic.config.main(
     ]
 )
 
+# Start image processing and pick up jobs lost by the last shutdown
+worker.init(gallery_config)
+worker.start_resume(gallery_config)
+
+# Compile the templates before the first request needs them
+templates.init(gallery_config)
+
 # Initialize app
 app = FastAPI(openapi_url=None, docs_url=None, redoc_url=None)
-app.mount("/b/static", StaticFiles(directory="static"), name="static")
-app.mount(
-    gallery_config.gallery_endpoint,
-    StaticFiles(directory=gallery_config.image_directory),
-    name="images",
-)
 
 # Rate limiting
 limiter = Limiter(key_func=get_remote_address)
@@ -38,6 +42,16 @@ app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
 api.configure(app, limiter, gallery_config)
 
+# Mounted after the API routes, some of which share the image prefix
+app.mount("/b/static", StaticFiles(directory="static"), name="static")
+
+if gallery_config.storage_backend == "local":
+    app.mount(
+        gallery_config.gallery_endpoint,
+        ImageFiles(directory=gallery_config.image_directory),
+        name="images",
+    )
+
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,198 @@
+"""Compares the image directory with the database and reports what is out of sync.
+
+    python reconcile_storage.py [--delete]
+
+Orphans are stored files no image refers to, e.g. left behind by a crashed
+save or a failed removal; --delete removes them. Files younger than the
+grace period are left alone, as they may belong to a save in progress.
+Dangling images are rows whose files are missing; they are only reported.
+
+Both sides are streamed in batches, so memory stays flat no matter how many
+images there are; only the directories of legacy images stored before
+content hashing are held in memory.
+"""
+
+import argparse
+import os
+import re
+import shutil
+import time
+from os import path
+from typing import Iterator, List, NamedTuple, Set
+
+from sqlmodel import Session, select
+
+import gallery.config as config
+import gallery.db as db
+from gallery.static import CONTENT_HASH
+from gallery.storage import storage_path
+
+# Images stored before content hashing got a directory named by a UUID
+LEGACY_DIRECTORY = re.compile(
+    r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
+)
+# Files being prepared before they are moved into place
+STAGING_PREFIXES = (".upload-", ".rendition-", ".download-")
+# Images are fanned out over two levels of these, see storage_directory()
+SHARD = re.compile(r"[0-9a-f]{2}")
+
+
+class DanglingImage(NamedTuple):
+    id: int
+    reason: str
+
+
+def find_orphans(
+    session: Session, image_directory: str, grace: float = 3600, batch_size: int = 1000
+) -> Iterator[str]:
+    """Yields the paths of stored files and directories that no image refers to."""
+    legacy_dirs = _legacy_directories(session, image_directory)
+    cutoff = time.time() - grace
+    batch = []
+
+    for entry in _stored_entries(image_directory):
+        if entry.stat(follow_symlinks=False).st_mtime > cutoff:
+            continue
+
+        if entry.name.startswith(STAGING_PREFIXES):
+            yield entry.path
+        elif CONTENT_HASH.fullmatch(entry.name) and entry.is_dir():
+            batch.append(entry)
+
+            if len(batch) == batch_size:
+                yield from _unreferenced(session, batch)
+                batch = []
+        elif LEGACY_DIRECTORY.fullmatch(entry.name) and entry.is_dir():
+            if entry.path not in legacy_dirs:
+                yield entry.path
+
+    yield from _unreferenced(session, batch)
+
+
+def _stored_entries(directory: str, depth: int = 2) -> Iterator[os.DirEntry]:
+    # Images stored before sharding still sit at the top level
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if depth > 0 and SHARD.fullmatch(entry.name) and entry.is_dir():
+                yield from _stored_entries(entry.path, depth - 1)
+            else:
+                yield entry
+
+
+def _unreferenced(session: Session, entries: List[os.DirEntry]) -> Iterator[str]:
+    if not entries:
+        return
+
+    names = [e.name for e in entries]
+    # Images whose blob row went missing still need their files, they are
+    # reported as dangling instead
+    referenced = set(
+        session.exec(
+            select(db.Blob.content_hash).where(db.Blob.content_hash.in_(names))
+        ).all()
+    ) | set(
+        session.exec(
+            select(db.Image.content_hash)
+            .where(db.Image.content_hash.in_(names))
+            .distinct()
+        ).all()
+    )
+
+    for entry in entries:
+        if entry.name not in referenced:
+            yield entry.path
+
+
+def _legacy_directories(session: Session, image_directory: str) -> Set[str]:
+    # No new legacy images are created, so this set doesn't grow
+    statement = select(db.Image.storage_key).where(db.Image.content_hash.is_(None))
+    return {
+        storage_path(image_directory, path.dirname(key))
+        for key in session.exec(statement)
+        if key
+    }
+
+
+def find_dangling(
+    session: Session, image_directory: str, batch_size: int = 1000
+) -> Iterator[DanglingImage]:
+    """Yields the images whose blob or files are missing."""
+    after = 0
+
+    while True:
+        # Plain columns, so no instances pile up in the session
+        statement = (
+            select(
+                db.Image.id,
+                db.Image.storage_key,
+                db.Image.thumbnail_key,
+                db.Image.content_hash,
+                db.Blob.content_hash,
+            )
+            .outerjoin(db.Blob, db.Blob.content_hash == db.Image.content_hash)
+            .where(db.Image.id > after)
+            .order_by(db.Image.id)
+            .limit(batch_size)
+        )
+        rows = session.exec(statement).all()
+
+        if not rows:
+            return
+
+        for image_id, key, thumbnail_key, content_hash, blob_hash in rows:
+            if content_hash and blob_hash is None:
+                yield DanglingImage(image_id, "blob is missing")
+            elif not path.exists(storage_path(image_directory, key)):
+                yield DanglingImage(image_id, f"{key} is missing")
+            elif thumbnail_key and not path.exists(
+                storage_path(image_directory, thumbnail_key)
+            ):
+                yield DanglingImage(image_id, f"{thumbnail_key} is missing")
+
+        after = rows[-1][0]
+
+
+def remove(orphan: str) -> None:
+    if path.isdir(orphan):
+        shutil.rmtree(orphan, ignore_errors=True)
+    else:
+        os.remove(orphan)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--delete", action="store_true", help="remove the orphans")
+    parser.add_argument(
+        "--grace",
+        type=float,
+        default=3600,
+        help="seconds before an unreferenced file counts as orphaned",
+    )
+    args = parser.parse_args()
+
+    gallery_config = config.get_config()
+
+    if gallery_config.storage_backend != "local":
+        parser.error("only images in the local image directory can be checked")
+    db.init(gallery_config)
+
+    orphans = dangling = 0
+
+    with Session(db.engine) as session:
+        for orphan in find_orphans(session, gallery_config.image_directory, args.grace):
+            print(f"orphan: {orphan}")
+            orphans += 1
+
+            if args.delete:
+                remove(orphan)
+
+        for image in find_dangling(session, gallery_config.image_directory):
+            print(f"dangling: image {image.id}, {image.reason}")
+            dangling += 1
+
+    action = "removed" if args.delete else "found"
+    print(f"{orphans} orphans {action}, {dangling} dangling images found")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""Regenerates the renditions of stored images, e.g. after RENDITION_WIDTHS changed.
+
+    python rethumbnail.py --rate 5
+
+Images are visited in id order, a batch at a time. Renditions are written to
+a directory named after the current settings, so images that are up to date
+are skipped and a rerun resumes an interrupted pass; --after skips ahead to
+the id printed last.
+"""
+
+import argparse
+import logging
+import time
+from os import path
+from typing import List, Optional
+
+from sqlalchemy import bindparam, update
+from sqlmodel import Session, select
+
+import alembic.config
+import gallery.config as config
+import gallery.db as db
+import gallery.response_cache as response_cache
+import gallery.worker as worker
+from gallery.storage import Storage, get_storage
+
+images_table = db.Image.__table__
+
+UPDATE_BY_HASH = (
+    update(images_table)
+    .where(images_table.c.content_hash == bindparam("b_key"))
+    .values(
+        renditions=bindparam("b_renditions"),
+        thumbnail_key=bindparam("b_thumbnail_key"),
+    )
+)
+
+# Skips images whose original was replaced while the renditions were made
+UPDATE_BY_ID = (
+    update(images_table)
+    .where(
+        images_table.c.id == bindparam("b_key"),
+        images_table.c.storage_key == bindparam("b_storage_key"),
+    )
+    .values(
+        renditions=bindparam("b_renditions"),
+        thumbnail_key=bindparam("b_thumbnail_key"),
+    )
+)
+
+
+class Throttle:
+    """Spaces out calls to wait() to at most rate per second."""
+
+    def __init__(self, rate: Optional[float]):
+        self.interval = 1 / rate if rate else 0
+        self.next = time.monotonic()
+
+    def wait(self) -> None:
+        now = time.monotonic()
+
+        if self.next > now:
+            time.sleep(self.next - now)
+
+        self.next = max(self.next, now) + self.interval
+
+
+def rethumbnail(
+    storage: Storage,
+    widths: List[int],
+    batch_size: int = 100,
+    rate: Optional[float] = None,
+    after: int = 0,
+) -> int:
+    """Regenerates all outdated renditions and returns how many images got new ones."""
+    throttle = Throttle(rate)
+    count = 0
+
+    with Session(db.engine) as session:
+        while True:
+            statement = (
+                select(db.Image)
+                .where(db.Image.id > after, ~db.Image.processing)
+                .order_by(db.Image.id)
+                .limit(batch_size)
+            )
+            images = session.exec(statement).all()
+
+            if not images:
+                break
+
+            count += _rethumbnail_batch(session, images, storage, widths, throttle)
+            after = images[-1].id
+            print(f"{count} images regenerated, up to id {after}")
+
+            # Later batches read the rows other batches updated afresh
+            session.expunge_all()
+
+    return count
+
+
+def _rethumbnail_batch(
+    session: Session,
+    images: List[db.Image],
+    storage: Storage,
+    widths: List[int],
+    throttle: Throttle,
+) -> int:
+    # Images sharing their content share the renditions, too
+    jobs = {}
+
+    for image in images:
+        if _is_current(image, widths):
+            continue
+
+        key = image.content_hash or image.id
+        jobs.setdefault(key, []).append(image)
+
+    futures = {}
+
+    for key, sharing in jobs.items():
+        throttle.wait()
+
+        with worker.reserve(block=True) as reservation:
+            futures[key] = reservation.submit(
+                worker.create_renditions,
+                storage,
+                sharing[0].storage_key,
+                widths,
+            )
+
+    by_hash, by_id, superseded = [], [], set()
+
+    for key, future in futures.items():
+        try:
+            renditions = future.result()
+        except Exception as e:
+            logging.error(f"Error processing image {jobs[key][0].storage_key}: {e}")
+            continue
+
+        params = {
+            "b_key": key,
+            "b_renditions": renditions,
+            "b_thumbnail_key": renditions[0]["key"],
+        }
+
+        if isinstance(key, str):
+            by_hash.append(params)
+        else:
+            params["b_storage_key"] = jobs[key][0].storage_key
+            by_id.append(params)
+
+        for image in jobs[key]:
+            if image.renditions:
+                superseded.add(path.dirname(image.renditions[0]["key"]))
+
+    # Rows sharing the content outside this batch are updated as well
+    updated = 0
+    if by_hash:
+        updated += session.execute(UPDATE_BY_HASH, by_hash).rowcount
+    if by_id:
+        updated += session.execute(UPDATE_BY_ID, by_id).rowcount
+    session.commit()
+    response_cache.invalidate()
+
+    for rendition_dir in superseded:
+        if path.basename(rendition_dir).startswith("renditions"):
+            storage.delete_directory(rendition_dir)
+
+    return updated
+
+
+def _is_current(image: db.Image, widths: List[int]) -> bool:
+    return bool(image.renditions) and path.dirname(
+        image.renditions[0]["key"]
+    ) == worker.rendition_directory(image.storage_key, widths)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--rate", type=float, help="at most this many images per second"
+    )
+    parser.add_argument("--after", type=int, default=0, help="start behind this id")
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    gallery_config = config.get_config()
+    db.init(gallery_config)
+    response_cache.init(gallery_config)
+    alembic.config.main(argv=["upgrade", "head"])
+    worker.init(gallery_config)
+
+    started = time.monotonic()
+    count = rethumbnail(
+        get_storage(gallery_config),
+        gallery_config.rendition_widths,
+        args.batch_size,
+        args.rate,
+        args.after,
+    )
+    worker.shutdown()
+
+    print(f"Done: {count} images in {time.monotonic() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
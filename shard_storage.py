@@ -0,0 +1,138 @@
+"""Moves images stored flat in the image directory into the sharded layout.
+
+    python shard_storage.py
+
+Images are visited in id order, a batch at a time: their directories are
+renamed to ab/cd/<name>/ and the paths of the whole batch are rewritten in
+one go. Already moved images are skipped, so an interrupted run continues
+when started again.
+"""
+
+import argparse
+import os
+import time
+from os import path
+from typing import Optional
+
+from sqlalchemy import bindparam, update
+from sqlmodel import Session, select
+
+import alembic.config
+import gallery.config as config
+import gallery.db as db
+import gallery.response_cache as response_cache
+from gallery.storage import storage_directory, storage_path
+
+images_table = db.Image.__table__
+
+UPDATE_PATHS = (
+    update(images_table)
+    .where(images_table.c.id == bindparam("b_id"))
+    .values(
+        storage_key=bindparam("b_storage_key"),
+        thumbnail_key=bindparam("b_thumbnail_key"),
+        renditions=bindparam("b_renditions"),
+    )
+)
+
+
+def shard_storage(image_directory: str, batch_size: int = 100) -> int:
+    """Moves all flat image directories and returns the number of updated images."""
+    after = 0
+    count = 0
+
+    with Session(db.engine) as session:
+        while True:
+            statement = (
+                select(
+                    db.Image.id,
+                    db.Image.storage_key,
+                    db.Image.thumbnail_key,
+                    db.Image.renditions,
+                )
+                .where(db.Image.id > after)
+                .order_by(db.Image.id)
+                .limit(batch_size)
+            )
+            rows = session.exec(statement).all()
+
+            if not rows:
+                break
+
+            params = []
+
+            for image_id, key, thumbnail_key, renditions in rows:
+                old_dir = path.dirname(key)
+
+                # Only keys of flat images consist of a directory and a file
+                if not old_dir or "/" in old_dir:
+                    continue
+
+                new_dir = storage_directory(old_dir)
+                _move(
+                    storage_path(image_directory, old_dir),
+                    storage_path(image_directory, new_dir),
+                )
+
+                params.append(
+                    {
+                        "b_id": image_id,
+                        "b_storage_key": _moved(key, old_dir, new_dir),
+                        "b_thumbnail_key": _moved(thumbnail_key, old_dir, new_dir),
+                        "b_renditions": renditions
+                        and [
+                            {**r, "key": _moved(r["key"], old_dir, new_dir)}
+                            for r in renditions
+                        ],
+                    }
+                )
+
+            if params:
+                session.execute(UPDATE_PATHS, params)
+                session.commit()
+                response_cache.invalidate()
+
+            count += len(params)
+            after = rows[-1][0]
+            print(f"{count} images moved, up to id {after}")
+
+    return count
+
+
+def _move(old_dir: str, new_dir: str) -> None:
+    # Images sharing their content share the directory, which is moved once
+    if not path.exists(old_dir) or path.exists(new_dir):
+        return
+
+    os.makedirs(path.dirname(new_dir), exist_ok=True)
+    os.rename(old_dir, new_dir)
+
+
+def _moved(key: Optional[str], old_dir: str, new_dir: str) -> Optional[str]:
+    if key and key.startswith(old_dir + "/"):
+        return new_dir + key[len(old_dir) :]
+
+    return key
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    gallery_config = config.get_config()
+
+    if gallery_config.storage_backend != "local":
+        parser.error("only images in the local image directory can be moved")
+    db.init(gallery_config)
+    response_cache.init(gallery_config)
+    alembic.config.main(argv=["upgrade", "head"])
+
+    started = time.monotonic()
+    count = shard_storage(gallery_config.image_directory, args.batch_size)
+
+    print(f"Done: {count} images in {time.monotonic() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,18 @@
+import io
 import pathlib
 import alembic
 from fastapi.testclient import TestClient
 import pytest
 
+import gallery.response_cache as response_cache
 from main import app, limiter
 
 
 @pytest.fixture
 def db_setup():
     limiter.reset()
+    # Cached responses would outlive the reset database
+    response_cache.invalidate()
     
     alembic.config.main(
         argv=[
@@ -70,14 +74,24 @@ def auth_service(user_service):
 
 
 @pytest.fixture
-def image_dir(tmp_path: pathlib.Path):
+def image_dir(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
     print("tmp_path", type(tmp_path))
     import gallery.config as config
 
     image_dir = tmp_path / "images"
     image_dir.mkdir(parents=True, exist_ok=True)
     
+    # The configuration is shared by the whole process
     gallery_config = config.get_config()
-    gallery_config.image_directory = str(image_dir)
+    monkeypatch.setattr(gallery_config, "image_directory", str(image_dir))
     
     return image_dir
+
+
+@pytest.fixture
+def jpeg_image() -> bytes:
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (400, 300), color="red").save(buffer, format="JPEG")
+    return buffer.getvalue()
@@ -1,8 +1,13 @@
+import io
 import pathlib
+import re
+import threading
 from fastapi.testclient import TestClient
+from PIL import Image
 
-from gallery import api, db
-from gallery.service import ImageService, UserService
+import gallery.config as config
+from gallery import api, db, worker
+from gallery.service import AuthService, ImageService, UserService
 
 
 def test_home_without_auth(client: TestClient):
@@ -25,8 +30,8 @@ def test_home_with_auth(
         title="some_image_with_auth",
         description="some_description",
         category="some_category",
-        url=str(image_dir / "some_image.jpg"),
-        thumbnail_url=str(image_dir / "some_thumbnail_image.jpg"),
+        storage_key="some_image.jpg",
+        thumbnail_key="some_thumbnail_image.jpg",
     )
     image = image_service.save(image, None)
 
@@ -38,6 +43,65 @@ def test_home_with_auth(
     assert "some_category" in response.text
 
 
+def test_home_renders_first_page_only(
+    client: TestClient,
+    user_service: UserService,
+    image_service: ImageService,
+    image_dir: pathlib.Path,
+):
+    _login(client, user_service)
+
+    for i in range(api.PAGE_SIZE + 1):
+        image = db.Image(
+            title=f"some_image_{i}",
+            description="some_description",
+            category=db.Category.BIRTHDAY,
+            storage_key="some_image.jpg",
+            thumbnail_key="some_thumbnail_image.jpg",
+        )
+        image_service.save(image, None)
+
+    response = client.get("/b/")
+    assert response.is_success
+    assert "some_image_0<" in response.text
+    assert f"some_image_{api.PAGE_SIZE}<" not in response.text
+
+    next_cursor = re.search(r'data-next-cursor="([^"]+)"', response.text).group(1)
+
+    response = client.get(f"/b/images/cards?cursor={next_cursor}")
+    assert response.is_success
+    assert f"some_image_{api.PAGE_SIZE}<" in response.text
+    assert "some_image_0<" not in response.text
+    assert "data-next-cursor" not in response.text
+
+    response = client.get("/b/images/cards?cursor=not_a_cursor")
+    assert response.status_code == 400
+
+
+def test_home_verifies_token_once(
+    client: TestClient, user_service: UserService, monkeypatch
+):
+    _login(client, user_service)
+
+    calls = []
+    verify_token = AuthService.verify_token
+
+    def record(self, token):
+        calls.append(token)
+        return verify_token(self, token)
+
+    monkeypatch.setattr(AuthService, "verify_token", record)
+
+    response = client.get("/b/")
+    assert response.is_success
+    assert len(calls) == 1
+
+
+def test_cannot_get_image_cards_without_auth(client: TestClient):
+    response = client.get("/b/images/cards")
+    assert response.status_code == 401
+
+
 def test_login_and_logout(client: TestClient, user_service: UserService):
     _login(client, user_service)
 
@@ -92,8 +156,8 @@ def test_delete_image(
         title="some_image",
         description="some_description",
         category="some_category",
-        url=str(image_dir / "some_image.jpg"),
-        thumbnail_url=str(image_dir / "some_thumbnail_image.jpg"),
+        storage_key="some_image.jpg",
+        thumbnail_key="some_thumbnail_image.jpg",
     )
     image = image_service.save(image, None)
 
@@ -107,6 +171,141 @@ def test_delete_image(
     assert image is None
 
 
+def test_add_image(
+    client: TestClient,
+    user_service: UserService,
+    image_dir: pathlib.Path,
+    image_service: ImageService,
+    jpeg_image: bytes,
+):
+    _login(client, user_service)
+
+    response = client.post(
+        "/b/images/add",
+        data={
+            "title": "some_uploaded_image",
+            "description": "some_description",
+            "category": db.Category.BIRTHDAY,
+        },
+        files={"image": ("some_image.jpg", jpeg_image, "image/jpeg")},
+    )
+    assert response.status_code == 200
+
+    page = image_service.get_image_page(1, api.PAGE_SIZE, "")
+    assert page["total"] == 1
+
+    image = image_service.get_image(page["content"][0].id)
+    assert image.processing is False
+    assert (image_dir / image.storage_key).read_bytes() == jpeg_image
+    assert (image_dir / image.thumbnail_key).exists()
+    assert page["content"][0].image_url == f"/b/gallery/images/{image.storage_key}"
+
+    # The 400px wide test image only fits the 320px rendition
+    assert [r["width"] for r in image.renditions] == [320]
+    assert re.search(r"/renditions-\w+/320\.jpg 320w$", page["content"][0].srcset)
+
+
+def test_add_image_rejects_non_image(
+    client: TestClient,
+    user_service: UserService,
+    image_dir: pathlib.Path,
+):
+    _login(client, user_service)
+
+    response = client.post(
+        "/b/images/add?lang=de",
+        data={
+            "title": "some_uploaded_image",
+            "description": "some_description",
+            "category": db.Category.BIRTHDAY,
+        },
+        files={"image": ("some_image.jpg", b"#!/bin/sh\necho hello", "image/jpeg")},
+    )
+    assert response.status_code == 200
+    assert "Die Datei ist kein unterstütztes Bild" in response.text
+    assert list(image_dir.iterdir()) == []
+
+
+def test_add_image_rejects_too_large_image(
+    client: TestClient,
+    user_service: UserService,
+    image_dir: pathlib.Path,
+    jpeg_image: bytes,
+    monkeypatch,
+):
+    monkeypatch.setattr(
+        config.get_config(), "max_upload_size", len(jpeg_image) - 1
+    )
+    _login(client, user_service)
+
+    response = client.post(
+        "/b/images/add?lang=de",
+        data={
+            "title": "some_uploaded_image",
+            "description": "some_description",
+            "category": db.Category.BIRTHDAY,
+        },
+        files={"image": ("some_image.jpg", jpeg_image, "image/jpeg")},
+    )
+    assert response.status_code == 200
+    assert "Das Bild ist zu groß" in response.text
+    assert list(image_dir.iterdir()) == []
+
+
+def test_add_image_rejects_oversized_request_up_front(
+    client: TestClient,
+    user_service: UserService,
+    image_dir: pathlib.Path,
+    monkeypatch,
+):
+    monkeypatch.setattr(config.get_config(), "max_upload_size", 1024)
+    _login(client, user_service)
+
+    response = client.post(
+        "/b/images/add",
+        data={
+            "title": "some_uploaded_image",
+            "description": "some_description",
+            "category": db.Category.BIRTHDAY,
+        },
+        files={
+            "image": (
+                "some_image.jpg",
+                b"\xff\xd8\xff" + bytes(api.FORM_OVERHEAD + 1024),
+                "image/jpeg",
+            )
+        },
+    )
+    assert response.status_code == 413
+    assert list(image_dir.iterdir()) == []
+
+
+def test_add_image_when_worker_is_saturated(
+    client: TestClient,
+    user_service: UserService,
+    image_dir: pathlib.Path,
+    jpeg_image: bytes,
+    monkeypatch,
+):
+    monkeypatch.setattr(worker, "slots", threading.BoundedSemaphore(1))
+    _login(client, user_service)
+
+    with worker.reserve():
+        response = client.post(
+            "/b/images/add",
+            data={
+                "title": "some_uploaded_image",
+                "description": "some_description",
+                "category": db.Category.BIRTHDAY,
+            },
+            files={"image": ("some_image.jpg", jpeg_image, "image/jpeg")},
+        )
+
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "10"
+    assert list(image_dir.iterdir()) == []
+
+
 def test_login_form(client: TestClient):
     response = client.get("/b/login")
     assert response.status_code == 200
@@ -150,8 +349,8 @@ def test_edit_image_form(
         title="some_image_edit",
         description="some_description",
         category=db.Category.ANNIVERSARY,
-        url=str(image_dir / "some_image.jpg"),
-        thumbnail_url=str(image_dir / "some_thumbnail_image.jpg"),
+        storage_key="some_image.jpg",
+        thumbnail_key="some_thumbnail_image.jpg",
     )
     image = image_service.save(image, None)
 
@@ -184,8 +383,8 @@ def test_cannot_edit_without_auth(
         title="some_image_edit",
         description="some_description",
         category=db.Category.ANNIVERSARY,
-        url=str(image_dir / "some_image.jpg"),
-        thumbnail_url=str(image_dir / "some_thumbnail_image.jpg"),
+        storage_key="some_image.jpg",
+        thumbnail_key="some_thumbnail_image.jpg",
     )
     image = image_service.save(image, None)
 
@@ -210,8 +409,8 @@ def test_get_gallery(
             title=f"some_image_{i}",
             description="some_description",
             category=db.Category.ANNIVERSARY,
-            url=str(image_dir / "some_image.jpg"),
-            thumbnail_url=str(image_dir / "some_thumbnail_image.jpg"),
+            storage_key="some_image.jpg",
+            thumbnail_key="some_thumbnail_image.jpg",
         )
         image = image_service.save(image, None)
 
@@ -237,6 +436,139 @@ def test_get_gallery(
     assert len(response.json()["content"]) == 1
 
 
+def test_get_gallery_with_cursor(
+    client: TestClient,
+    image_service: ImageService,
+    image_dir: pathlib.Path,
+):
+    for i in range(api.PAGE_SIZE + 1):
+        image = db.Image(
+            title=f"some_image_{i}",
+            description="some_description",
+            category=db.Category.ANNIVERSARY,
+            storage_key="some_image.jpg",
+            thumbnail_key="some_thumbnail_image.jpg",
+        )
+        image = image_service.save(image, None)
+
+    response = client.get("/b/images/gallery")
+    assert response.status_code == 200
+    next_cursor = response.json()["next_cursor"]
+    assert next_cursor is not None
+
+    response = client.get(f"/b/images/gallery?cursor={next_cursor}")
+    assert response.status_code == 200
+    assert response.json()["page_no"] is None
+    assert response.json()["total"] is None
+    assert response.json()["has_next"] is False
+    assert response.json()["has_previous"] is True
+    assert response.json()["next_cursor"] is None
+    assert [image["title"] for image in response.json()["content"]] == [
+        f"some_image_{api.PAGE_SIZE}"
+    ]
+
+    response = client.get("/b/images/gallery?cursor=not_a_cursor")
+    assert response.status_code == 400
+
+
+def test_get_gallery_is_cached_until_images_change(
+    client: TestClient,
+    image_service: ImageService,
+    image_dir: pathlib.Path,
+):
+    image = db.Image(
+        title="some_image",
+        description="some_description",
+        category=db.Category.ANNIVERSARY,
+        storage_key="some_image.jpg",
+    )
+    image_service.save(image, None)
+
+    response = client.get("/b/images/gallery")
+    assert response.status_code == 200
+    assert response.json()["total"] == 1
+    etag = response.headers["etag"]
+
+    response = client.get("/b/images/gallery", headers={"if-none-match": etag})
+    assert response.status_code == 304
+
+    image_service.delete(image.id)
+
+    response = client.get("/b/images/gallery", headers={"if-none-match": etag})
+    assert response.status_code == 200
+    assert response.json()["total"] == 0
+    assert response.headers["etag"] != etag
+
+
+def test_get_categories_is_cached_per_language(
+    client: TestClient,
+    image_service: ImageService,
+    image_dir: pathlib.Path,
+):
+    image = db.Image(
+        title="some_image",
+        description="some_description",
+        category=db.Category.BIRTHDAY,
+        storage_key="some_image.jpg",
+    )
+    image_service.save(image, None)
+
+    german = client.get("/b/images/categories?lang=de")
+    english = client.get("/b/images/categories?lang=en")
+    assert german.status_code == english.status_code == 200
+    assert german.headers["vary"] == "Accept-Language"
+    assert german.headers["etag"] != english.headers["etag"]
+    assert german.json() == [
+        {"key": db.Category.BIRTHDAY, "name": "Geburtstag", "count": 1}
+    ]
+
+
+def test_get_resized_image(
+    client: TestClient,
+    user_service: UserService,
+    image_dir: pathlib.Path,
+    image_service: ImageService,
+    jpeg_image: bytes,
+):
+    _login(client, user_service)
+
+    client.post(
+        "/b/images/add",
+        data={
+            "title": "some_uploaded_image",
+            "description": "some_description",
+            "category": db.Category.BIRTHDAY,
+        },
+        files={"image": ("some_image.jpg", jpeg_image, "image/jpeg")},
+    )
+    image_id = image_service.get_image_page(1, api.PAGE_SIZE, "")["content"][0].id
+
+    response = client.get(f"/b/gallery/images/{image_id}/w/100")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/jpeg"
+    with Image.open(io.BytesIO(response.content)) as img:
+        assert img.size == (100, 75)
+
+    response = client.get(
+        f"/b/gallery/images/{image_id}/w/100",
+        headers={"if-none-match": response.headers["etag"]},
+    )
+    assert response.status_code == 304
+
+    response = client.get(
+        f"/b/gallery/images/{image_id}/w/100", headers={"accept": "image/webp"}
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/webp"
+    assert response.headers["vary"] == "Accept"
+
+    response = client.get(f"/b/gallery/images/{image_id}/w/5000")
+    assert response.status_code == 422
+
+    response = client.get("/b/gallery/images/0/w/100")
+    assert response.status_code == 404
+
+
 def _login(client: TestClient, user_service: UserService):
     # Create a user and save it to the database
     user = db.User(username="some_user", email="some_user@example.xyz")
@@ -0,0 +1,42 @@
+import pathlib
+
+from sqlmodel import select
+
+from gallery import db
+from gallery.service import ImageService
+from import_images import import_directory
+
+
+def test_import_directory_skips_imported_files(
+    image_dir: pathlib.Path,
+    image_service: ImageService,
+    jpeg_image: bytes,
+    tmp_path: pathlib.Path,
+):
+    photos = tmp_path / "photos"
+    (photos / "2019").mkdir(parents=True)
+    (photos / "2019" / "cake.jpg").write_bytes(jpeg_image)
+    (photos / "2019" / "cake copy.JPG").write_bytes(jpeg_image)
+    (photos / "notes.txt").write_text("not an image")
+    (photos / "broken.png").write_text("not an image either")
+
+    count = import_directory(str(photos), db.Category.BIRTHDAY, 2)
+
+    assert count == 2
+    page = image_service.get_image_page(1, 10, "")
+    assert sorted(image.title for image in page["content"]) == ["cake", "cake copy"]
+    assert all(image.thumbnail_url for image in page["content"])
+    (blob,) = image_service.session.exec(select(db.Blob)).all()
+    assert blob.ref_count == 2
+
+    (photos / "2020").mkdir()
+    (photos / "2020" / "candles.jpg").write_bytes(jpeg_image)
+
+    count = import_directory(str(photos), db.Category.BIRTHDAY, 2)
+
+    assert count == 1
+    assert image_service.get_image_page(1, 10, "")["total"] == 3
+
+    # Rejected files are recorded as well, and not tried again
+    imported = image_service.session.exec(select(db.ImportedFile.path)).all()
+    assert len(imported) == 4
@@ -0,0 +1,88 @@
+import io
+import pathlib
+
+from fastapi import UploadFile
+from sqlmodel import delete
+
+from gallery import db
+from gallery.service import ImageService
+from reconcile_storage import find_dangling, find_orphans
+
+
+def test_find_orphans_and_dangling_images(
+    image_dir: pathlib.Path, image_service: ImageService, jpeg_image: bytes
+):
+    image = db.Image(
+        title="some_image",
+        description="some_description",
+        category=db.Category.BIRTHDAY,
+    )
+    upload = UploadFile(file=io.BytesIO(jpeg_image), filename="some_image.jpg")
+    image_service.save(image, upload)
+
+    legacy_dir = image_dir / "0b5e3bbb-4f5c-4bd4-9a8e-4f0d9a6d6d0e"
+    legacy_dir.mkdir()
+    (legacy_dir / "some_image.jpg").write_bytes(jpeg_image)
+    image_service.save(
+        db.Image(
+            title="legacy_image",
+            description="some_description",
+            category=db.Category.BIRTHDAY,
+            storage_key=f"{legacy_dir.name}/some_image.jpg",
+        ),
+        None,
+    )
+    missing = image_service.save(
+        db.Image(
+            title="missing_image",
+            description="some_description",
+            category=db.Category.BIRTHDAY,
+            storage_key="1d0c5e8f-1f2a-4c3b-8d4e-5f6a7b8c9d0e/gone.jpg",
+        ),
+        None,
+    )
+
+    orphaned_hash_dir = image_dir / "ab" / "ab" / ("ab" * 32)
+    orphaned_hash_dir.mkdir(parents=True)
+    unsharded_hash_dir = image_dir / ("cd" * 32)
+    unsharded_hash_dir.mkdir()
+    orphaned_legacy_dir = image_dir / "7c9e6679-7425-40de-944b-e07fc1f90ae7"
+    orphaned_legacy_dir.mkdir()
+    leftover_upload = image_dir / ".upload-7c9e6679"
+    leftover_upload.write_bytes(b"partial")
+
+    orphans = find_orphans(image_service.session, str(image_dir), grace=0, batch_size=1)
+    assert sorted(orphans) == sorted(
+        [
+            str(orphaned_hash_dir),
+            str(unsharded_hash_dir),
+            str(orphaned_legacy_dir),
+            str(leftover_upload),
+        ]
+    )
+
+    # Files younger than the grace period may belong to a save in progress
+    assert list(find_orphans(image_service.session, str(image_dir))) == []
+
+    dangling = list(find_dangling(image_service.session, str(image_dir), batch_size=1))
+    assert [image.id for image in dangling] == [missing.id]
+
+
+def test_find_orphans_keeps_files_of_images_without_blob(
+    image_dir: pathlib.Path, image_service: ImageService, jpeg_image: bytes
+):
+    image = db.Image(
+        title="some_image",
+        description="some_description",
+        category=db.Category.BIRTHDAY,
+    )
+    upload = UploadFile(file=io.BytesIO(jpeg_image), filename="some_image.jpg")
+    image_service.save(image, upload)
+
+    image_service.session.exec(delete(db.Blob))
+    image_service.session.commit()
+
+    assert list(find_orphans(image_service.session, str(image_dir), grace=0)) == []
+
+    dangling = list(find_dangling(image_service.session, str(image_dir)))
+    assert dangling == [(image.id, "blob is missing")]
@@ -0,0 +1,82 @@
+import pathlib
+import threading
+import time
+
+from gallery.rendition_cache import RenditionCache
+
+
+def _writer(content: bytes, calls: list):
+    def create(file_path: str):
+        calls.append(file_path)
+        pathlib.Path(file_path).write_bytes(content)
+
+    return create
+
+
+def test_get_creates_once_and_serves_from_disk(tmp_path: pathlib.Path):
+    cache = RenditionCache(str(tmp_path), max_size=1024)
+    calls = []
+
+    first = cache.get("some_key.jpg", _writer(b"some_content", calls))
+    second = cache.get("some_key.jpg", _writer(b"other_content", calls))
+
+    assert first == second == str(tmp_path / "some_key.jpg")
+    assert pathlib.Path(first).read_bytes() == b"some_content"
+    assert len(calls) == 1
+
+
+def test_get_evicts_least_recently_used(tmp_path: pathlib.Path):
+    cache = RenditionCache(str(tmp_path), max_size=25)
+    calls = []
+
+    cache.get("a.jpg", _writer(b"0123456789", calls))
+    cache.get("b.jpg", _writer(b"0123456789", calls))
+    cache.get("a.jpg", _writer(b"0123456789", calls))
+    cache.get("c.jpg", _writer(b"0123456789", calls))
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a.jpg", "c.jpg"]
+    assert cache.size == 20
+
+    # A restarted cache adopts the remaining files
+    assert RenditionCache(str(tmp_path), max_size=25).size == 20
+
+
+def test_get_coalesces_concurrent_misses(tmp_path: pathlib.Path):
+    cache = RenditionCache(str(tmp_path), max_size=1024)
+    calls = []
+
+    def slow_create(file_path: str):
+        calls.append(file_path)
+        time.sleep(0.2)
+        pathlib.Path(file_path).write_bytes(b"some_content")
+
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(cache.get("some_key.jpg", slow_create))
+        )
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == [str(tmp_path / "some_key.jpg")] * 5
+
+
+def test_get_recreates_files_evicted_by_another_process(tmp_path: pathlib.Path):
+    calls = []
+    cache = RenditionCache(str(tmp_path), max_size=15)
+    cache.get("a.jpg", _writer(b"0123456789", calls))
+
+    other = RenditionCache(str(tmp_path), max_size=15)
+    other.get("b.jpg", _writer(b"0123456789", calls))
+    assert not (tmp_path / "a.jpg").exists()
+
+    file_path = cache.get("a.jpg", _writer(b"0123456789", calls))
+
+    assert pathlib.Path(file_path).read_bytes() == b"0123456789"
+    assert len(calls) == 3
+    assert cache.size == 10
@@ -0,0 +1,65 @@
+import os
+import pathlib
+
+import pytest
+
+import gallery.response_cache as response_cache
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(response_cache, "max_entries", 2)
+    monkeypatch.setattr(response_cache, "ttl", 60.0)
+    monkeypatch.setattr(response_cache, "version_file", None)
+    response_cache.invalidate()
+
+
+def test_get_returns_entries_of_the_current_version_only():
+    version = response_cache.version()
+    cached = response_cache.put("some_key", version, b"some_body")
+
+    assert response_cache.get("some_key") == cached
+    assert cached.etag.startswith('"')
+
+    # Built before the change, but stored after it
+    response_cache.invalidate()
+    response_cache.put("some_key", version, b"some_body")
+
+    assert response_cache.get("some_key") is None
+
+
+def test_put_evicts_least_recently_used():
+    version = response_cache.version()
+
+    response_cache.put("a", version, b"a")
+    response_cache.put("b", version, b"b")
+    response_cache.get("a")
+    response_cache.put("c", version, b"c")
+
+    assert response_cache.get("a") is not None
+    assert response_cache.get("b") is None
+    assert response_cache.get("c") is not None
+
+
+def test_get_drops_expired_entries(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(response_cache, "ttl", -1.0)
+
+    response_cache.put("some_key", response_cache.version(), b"some_body")
+
+    assert response_cache.get("some_key") is None
+
+
+def test_version_file_is_shared_between_processes(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+):
+    version_file = tmp_path / "response-cache-version"
+    monkeypatch.setattr(response_cache, "version_file", str(version_file))
+
+    response_cache.put("some_key", response_cache.version(), b"some_body")
+    assert response_cache.get("some_key") is not None
+
+    # Another process touching the file
+    version_file.touch()
+    os.utime(version_file, ns=(0, 0))
+
+    assert response_cache.get("some_key") is None
@@ -0,0 +1,83 @@
+import io
+import pathlib
+
+import pytest
+from fastapi import UploadFile
+from PIL import Image
+from sqlalchemy import update
+
+from gallery import db, worker
+from gallery.service import ImageService
+from gallery.storage import LocalStorage
+from rethumbnail import rethumbnail
+
+
+def test_rethumbnail_writes_new_renditions(
+    image_dir: pathlib.Path, image_service: ImageService
+):
+    buffer = io.BytesIO()
+    Image.new("RGB", (800, 600), color="red").save(buffer, format="JPEG")
+
+    images = []
+    for filename in ("some_image.jpg", "same_image_again.jpg"):
+        image = db.Image(
+            title=filename,
+            description="some_description",
+            category=db.Category.BIRTHDAY,
+        )
+        upload = UploadFile(file=io.BytesIO(buffer.getvalue()), filename=filename)
+        images.append(image_service.save(image, upload))
+
+    old_dir = image_dir / pathlib.Path(images[0].thumbnail_key).parent
+
+    assert rethumbnail(LocalStorage(str(image_dir)), [100, 200], batch_size=1) == 2
+
+    for image in images:
+        image_service.session.refresh(image)
+        assert [r["width"] for r in image.renditions] == [100, 200]
+        assert (image_dir / image.thumbnail_key).exists()
+
+    assert image_dir / pathlib.Path(images[0].thumbnail_key).parent != old_dir
+    assert not old_dir.exists()
+
+    assert rethumbnail(LocalStorage(str(image_dir)), [100, 200]) == 0
+
+
+def test_rethumbnail_skips_legacy_images_replaced_meanwhile(
+    image_dir: pathlib.Path,
+    image_service: ImageService,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    (image_dir / "legacy").mkdir()
+    Image.new("RGB", (800, 600), color="red").save(image_dir / "legacy/old.jpg")
+
+    image = db.Image(
+        title="some_image",
+        description="some_description",
+        category=db.Category.BIRTHDAY,
+        storage_key="legacy/old.jpg",
+        thumbnail_key="legacy/old.jpg",
+    )
+    image = image_service.save(image, None)
+
+    create_renditions = worker.create_renditions
+
+    def replace_while_rendering(*args):
+        renditions = create_renditions(*args)
+
+        with db.engine.begin() as connection:
+            connection.execute(
+                update(db.Image.__table__)
+                .where(db.Image.__table__.c.id == image.id)
+                .values(storage_key="legacy/new.jpg")
+            )
+
+        return renditions
+
+    monkeypatch.setattr(worker, "create_renditions", replace_while_rendering)
+
+    assert rethumbnail(LocalStorage(str(image_dir)), [100, 200]) == 0
+
+    image_service.session.refresh(image)
+    assert image.storage_key == "legacy/new.jpg"
+    assert image.renditions is None
@@ -0,0 +1,392 @@
+import asyncio
+import io
+import pathlib
+from concurrent.futures import Future
+
+import pytest
+from fastapi import UploadFile
+from PIL import Image
+from sqlalchemy import event, text
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from gallery import db, worker
+from gallery.service import AsyncImageService, ImageService, InvalidImageError
+
+
+def test_get_image_page_queries_only_requested_window(
+    image_service: ImageService, image_dir: pathlib.Path
+):
+    for i in range(25):
+        image = db.Image(
+            title=f"some_image_{i}",
+            description="some_description",
+            category=db.Category.BIRTHDAY,
+            storage_key="some_image.jpg",
+            thumbnail_key="some_thumbnail_image.jpg",
+        )
+        image_service.save(image, None)
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+        page = image_service.get_image_page(2, 10, db.Category.BIRTHDAY)
+    finally:
+        event.remove(db.engine, "before_cursor_execute", record)
+
+    assert page["total"] == 25
+    assert page["total_pages"] == 3
+    assert [image.title for image in page["content"]] == [
+        f"some_image_{i}" for i in range(10, 20)
+    ]
+
+    assert len(statements) == 2
+
+    count_statement, _ = statements[0]
+    assert "count(*)" in count_statement
+    assert "LIMIT" not in count_statement
+
+    page_statement, _ = statements[1]
+    assert "ORDER BY image.created_at, image.id" in page_statement
+    assert "LIMIT" in page_statement
+    assert "OFFSET" in page_statement
+
+
+def test_async_image_service_returns_same_pages(image_service: ImageService):
+    for i in range(5):
+        image = db.Image(
+            title=f"some_image_{i}",
+            description="some_description",
+            category=db.Category.BIRTHDAY,
+            storage_key="some_image.jpg",
+        )
+        image_service.save(image, None)
+
+    async def get_pages():
+        async with AsyncSession(db.async_engine) as session:
+            service = AsyncImageService(session)
+            page = await service.get_image_page(2, 2, db.Category.BIRTHDAY)
+            page_after = await service.get_image_page_after(
+                page["next_cursor"], 2, ""
+            )
+            return page, page_after, await service.get_categories()
+
+    page, page_after, categories = asyncio.run(get_pages())
+
+    assert page == image_service.get_image_page(2, 2, db.Category.BIRTHDAY)
+    assert page_after == image_service.get_image_page_after(
+        page["next_cursor"], 2, ""
+    )
+    assert categories == image_service.get_categories()
+
+
+def test_category_counts_follow_saves_updates_and_deletes(
+    image_dir: pathlib.Path, image_service: ImageService
+):
+    images = []
+    for i, category in enumerate(
+        (db.Category.BIRTHDAY, db.Category.BIRTHDAY, db.Category.LOVE)
+    ):
+        image = db.Image(
+            title="some_image",
+            description="some_description",
+            category=category,
+            storage_key=f"some_dir_{i}/some_image.jpg",
+        )
+        images.append(image_service.save(image, None))
+
+    assert image_service.get_categories() == [
+        (db.Category.BIRTHDAY, 2),
+        (db.Category.LOVE, 1),
+    ]
+
+    image_service.update(
+        images[0], "some_image", "some_description", db.Category.LOVE, None
+    )
+    image_service.delete(images[2].id)
+
+    assert image_service.get_categories() == [
+        (db.Category.BIRTHDAY, 1),
+        (db.Category.LOVE, 1),
+    ]
+
+    image_service.delete(images[1].id)
+
+    # Emptied categories are no longer listed
+    assert image_service.get_categories() == [(db.Category.LOVE, 1)]
+
+
+class DeferredExecutor:
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.jobs.append((future, fn, args))
+        return future
+
+    def run(self):
+        for future, fn, args in self.jobs:
+            future.set_result(fn(*args))
+
+
+def test_save_defers_processing_to_worker(
+    image_dir: pathlib.Path,
+    image_service: ImageService,
+    jpeg_image: bytes,
+    monkeypatch,
+):
+    executor = DeferredExecutor()
+    monkeypatch.setattr(worker, "executor", executor)
+
+    image = db.Image(
+        title="some_image",
+        description="some_description",
+        category=db.Category.BIRTHDAY,
+    )
+    upload = UploadFile(file=io.BytesIO(jpeg_image), filename="some_image.jpg")
+    image = image_service.save(image, upload)
+
+    assert image.processing is True
+    assert image.thumbnail_key is None
+    assert image_service.get_image_page(1, 10, "")["total"] == 0
+    assert image_service.get_categories() == []
+
+    executor.run()
+    image_service.session.refresh(image)
+
+    assert image.processing is False
+    assert (image_dir / image.thumbnail_key).exists()
+    assert image_service.get_image_page(1, 10, "")["total"] == 1
+    assert image_service.get_categories() == [(db.Category.BIRTHDAY, 1)]
+
+
+def test_failed_processing_leaves_image_without_renditions(
+    image_dir: pathlib.Path,
+    image_service: ImageService,
+    jpeg_image: bytes,
+    monkeypatch,
+):
+    def fail(*args):
+        raise OSError("some_error")
+
+    monkeypatch.setattr(worker, "create_renditions", fail)
+
+    image = db.Image(
+        title="some_image",
+        description="some_description",
+        category=db.Category.BIRTHDAY,
+    )
+    upload = UploadFile(file=io.BytesIO(jpeg_image), filename="some_image.jpg")
+    image = image_service.save(image, upload)
+    image_service.session.refresh(image)
+
+    assert image.processing is False
+    assert image.thumbnail_key is None
+    assert image.renditions is None
+    assert image_service.get_image_page(1, 10, "")["total"] == 1
+
+
+def test_resume_pending_requeues_interrupted_images(
+    image_dir: pathlib.Path,
+    image_service: ImageService,
+    jpeg_image: bytes,
+    monkeypatch,
+):
+    monkeypatch.setattr(worker, "executor", DeferredExecutor())
+
+    image = db.Image(
+        title="some_image",
+        description="some_description",
+        category=db.Category.BIRTHDAY,
+    )
+    upload = UploadFile(file=io.BytesIO(jpeg_image), filename="some_image.jpg")
+    image = image_service.save(image, upload)
+
+    # The job queued by the save is lost, like on a restart
+    monkeypatch.setattr(worker, "executor", None)
+    worker.start_resume(image_service.config)
+    image_service.session.refresh(image)
+
+    assert image.processing is False
+    assert (image_dir / image.thumbnail_key).exists()
+
+
+def test_resume_pending_leaves_images_to_the_lock_holder(
+    image_dir: pathlib.Path,
+    image_service: ImageService,
+    jpeg_image: bytes,
+    monkeypatch,
+):
+    if db.engine.dialect.name != "postgresql":
+        pytest.skip("Advisory locks need PostgreSQL")
+
+    monkeypatch.setattr(worker, "executor", DeferredExecutor())
+
+    image = db.Image(
+        title="some_image",
+        description="some_description",
+        category=db.Category.BIRTHDAY,
+    )
+    upload = UploadFile(file=io.BytesIO(jpeg_image), filename="some_image.jpg")
+    image = image_service.save(image, upload)
+
+    monkeypatch.setattr(worker, "executor", None)
+
+    # Another process is resuming the backlog
+    with db.engine.connect() as connection:
+        statement = text("SELECT pg_try_advisory_lock(:key)")
+        assert connection.execute(statement, {"key": worker.RESUME_LOCK}).scalar()
+
+        try:
+            worker.start_resume(image_service.config)
+        finally:
+            connection.execute(
+                text("SELECT pg_advisory_unlock(:key)"), {"key": worker.RESUME_LOCK}
+            )
+
+    image_service.session.refresh(image)
+
+    assert image.processing is True
+    assert image.thumbnail_key is None
+
+
+def test_save_rejects_decompression_bomb(
+    image_dir: pathlib.Path,
+    image_service: ImageService,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    monkeypatch.setattr(image_service.config, "max_image_pixels", 100 * 100)
+
+    # Compresses to a few hundred bytes but decodes to 100 MB
+    buffer = io.BytesIO()
+    Image.new("1", (10_000, 10_000)).save(buffer, format="PNG")
+
+    image = db.Image(
+        title="some_image",
+        description="some_description",
+        category=db.Category.BIRTHDAY,
+    )
+    upload = UploadFile(file=io.BytesIO(buffer.getvalue()), filename="bomb.png")
+
+    with pytest.raises(InvalidImageError):
+        image_service.save(image, upload)
+
+    assert list(image_dir.iterdir()) == []
+
+
+def test_save_deduplicates_identical_uploads(
+    image_dir: pathlib.Path, image_service: ImageService, jpeg_image: bytes
+):
+    images = []
+    for filename in ("some_image.jpg", "same_image_again.jpeg"):
+        image = db.Image(
+            title=filename,
+            description="some_description",
+            category=db.Category.BIRTHDAY,
+        )
+        upload = UploadFile(file=io.BytesIO(jpeg_image), filename=filename)
+        images.append(image_service.save(image, upload))
+
+    first, second = images
+    assert first.storage_key == second.storage_key
+    assert first.storage_key == (
+        f"{first.content_hash[:2]}/{first.content_hash[2:4]}/"
+        f"{first.content_hash}/original.jpg"
+    )
+    assert second.processing is False
+    assert second.renditions == first.renditions
+    assert [p.name for p in image_dir.glob("*/*/*")] == [first.content_hash]
+    assert image_service.session.get(db.Blob, first.content_hash).ref_count == 2
+
+    image_service.delete(first.id)
+    assert (image_dir / second.storage_key).exists()
+
+    image_service.delete(second.id)
+    assert list(image_dir.glob("*/*/*")) == []
+    assert image_service.session.get(db.Blob, second.content_hash) is None
+
+
+def test_update_skips_unchanged_upload(
+    image_dir: pathlib.Path, image_service: ImageService, jpeg_image: bytes
+):
+    image = db.Image(
+        title="some_image",
+        description="some_description",
+        category=db.Category.BIRTHDAY,
+    )
+    upload = UploadFile(file=io.BytesIO(jpeg_image), filename="some_image.jpg")
+    image = image_service.save(image, upload)
+    updated_at = image.updated_at
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+        upload = UploadFile(file=io.BytesIO(jpeg_image), filename="again.jpg")
+        image_service.update(
+            image, "some_image", "some_description", db.Category.BIRTHDAY, upload
+        )
+        assert statements == []
+
+        image_service.update(
+            image, "new_title", "some_description", db.Category.BIRTHDAY, None
+        )
+    finally:
+        event.remove(db.engine, "before_cursor_execute", record)
+
+    updates = [s for s in statements if s.startswith("UPDATE")]
+    assert len(updates) == 1
+    assert updates[0].startswith("UPDATE image SET title=")
+    assert "storage_key" not in updates[0]
+    assert image.updated_at > updated_at
+    assert image_service.session.get(db.Blob, image.content_hash).ref_count == 1
+
+
+def test_update_removes_superseded_files(
+    image_dir: pathlib.Path, image_service: ImageService, jpeg_image: bytes
+):
+    image = db.Image(
+        title="some_image",
+        description="some_description",
+        category=db.Category.BIRTHDAY,
+    )
+    upload = UploadFile(file=io.BytesIO(jpeg_image), filename="some_image.jpg")
+    image = image_service.save(image, upload)
+    old_hash = image.content_hash
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (400, 300), color="green").save(buffer, format="JPEG")
+    upload = UploadFile(file=io.BytesIO(buffer.getvalue()), filename="new.jpg")
+    image_service.update(
+        image, "some_image", "some_description", db.Category.BIRTHDAY, upload
+    )
+
+    assert image.content_hash != old_hash
+    assert [p.name for p in image_dir.glob("*/*/*")] == [image.content_hash]
+    assert image_service.session.get(db.Blob, old_hash) is None
+
+
+def test_delete_keeps_image_directory_for_keys_without_directory(
+    image_dir: pathlib.Path, image_service: ImageService
+):
+    (image_dir / "other_image.jpg").write_bytes(b"some_content")
+
+    image = db.Image(
+        title="some_image",
+        description="some_description",
+        category=db.Category.BIRTHDAY,
+        storage_key="some_image.jpg",
+        thumbnail_key="some_thumbnail_image.jpg",
+    )
+    image = image_service.save(image, None)
+
+    image_service.delete(image.id)
+
+    assert (image_dir / "other_image.jpg").exists()
@@ -0,0 +1,64 @@
+import pathlib
+
+from sqlmodel import select
+
+from gallery import db
+from gallery.service import ImageService
+from shard_storage import shard_storage
+
+
+def test_shard_storage_moves_flat_directories(
+    image_dir: pathlib.Path, image_service: ImageService, jpeg_image: bytes
+):
+    content_hash = "ab" * 32
+    flat_dir = image_dir / content_hash
+    (flat_dir / "renditions").mkdir(parents=True)
+    (flat_dir / "original.jpg").write_bytes(jpeg_image)
+    (flat_dir / "renditions" / "320.jpg").write_bytes(jpeg_image)
+
+    legacy_dir = image_dir / "0b5e3bbb-4f5c-4bd4-9a8e-4f0d9a6d6d0e"
+    legacy_dir.mkdir()
+    (legacy_dir / "some_image.jpg").write_bytes(jpeg_image)
+    (legacy_dir / "thumbnail.jpg").write_bytes(jpeg_image)
+
+    for title in ("some_image", "same_image_again"):
+        image_service.save(
+            db.Image(
+                title=title,
+                description="some_description",
+                category=db.Category.BIRTHDAY,
+                storage_key=f"{content_hash}/original.jpg",
+                content_hash=content_hash,
+                thumbnail_key=f"{content_hash}/renditions/320.jpg",
+                renditions=[
+                    {"width": 320, "key": f"{content_hash}/renditions/320.jpg"}
+                ],
+            ),
+            None,
+        )
+    legacy = image_service.save(
+        db.Image(
+            title="legacy_image",
+            description="some_description",
+            category=db.Category.BIRTHDAY,
+            storage_key=f"{legacy_dir.name}/some_image.jpg",
+            thumbnail_key=f"{legacy_dir.name}/thumbnail.jpg",
+        ),
+        None,
+    )
+
+    assert shard_storage(str(image_dir), batch_size=1) == 3
+
+    sharded_dir = image_dir / "ab" / "ab" / content_hash
+    for image in image_service.session.exec(select(db.Image)).all():
+        image_service.session.refresh(image)
+        assert image.storage_key.startswith("ab/ab/") or image.id == legacy.id
+        assert (image_dir / image.storage_key).exists()
+        assert (image_dir / image.thumbnail_key).exists()
+        assert all((image_dir / r["key"]).exists() for r in image.renditions or [])
+
+    assert legacy.storage_key == f"0b/5e/{legacy_dir.name}/some_image.jpg"
+    assert not flat_dir.exists()
+    assert pathlib.Path(sharded_dir / "renditions" / "320.jpg").exists()
+
+    assert shard_storage(str(image_dir)) == 0
@@ -0,0 +1,71 @@
+import pathlib
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from gallery.static import ImageFiles
+
+
+def _client(image_dir: pathlib.Path) -> TestClient:
+    app = FastAPI()
+    app.mount("/images", ImageFiles(directory=image_dir), name="images")
+    return TestClient(app)
+
+
+def test_images_are_cached_immutably(tmp_path: pathlib.Path):
+    content = b"some_rendition"
+    (tmp_path / "renditions").mkdir()
+    (tmp_path / "renditions" / "320.jpg").write_bytes(content)
+    client = _client(tmp_path)
+
+    response = client.get("/images/renditions/320.jpg")
+    assert response.status_code == 200
+    assert response.content == content
+    assert response.headers["cache-control"] == "public, max-age=31536000, immutable"
+    etag = response.headers["etag"]
+
+    response = client.get(
+        "/images/renditions/320.jpg", headers={"if-none-match": etag}
+    )
+    assert response.status_code == 304
+    assert response.content == b""
+
+    # Replaced files, e.g. by a restored backup, get a new ETag
+    (tmp_path / "renditions" / "320.jpg").write_bytes(b"other_rendition")
+
+    response = client.get(
+        "/images/renditions/320.jpg", headers={"if-none-match": etag}
+    )
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+
+
+def test_original_etag_is_its_content_hash(tmp_path: pathlib.Path):
+    content_hash = "a" * 64
+    (tmp_path / content_hash).mkdir()
+    (tmp_path / content_hash / "original.jpg").write_bytes(b"some_image")
+    client = _client(tmp_path)
+
+    response = client.get(f"/images/{content_hash}/original.jpg")
+    assert response.status_code == 200
+    assert response.headers["etag"] == f'"{content_hash}"'
+
+
+def test_renditions_are_negotiated(tmp_path: pathlib.Path):
+    (tmp_path / "renditions").mkdir()
+    (tmp_path / "renditions" / "320.jpg").write_bytes(b"some_jpeg")
+    (tmp_path / "renditions" / "320.webp").write_bytes(b"some_webp")
+    client = _client(tmp_path)
+
+    response = client.get(
+        "/images/renditions/320.jpg", headers={"accept": "image/webp,*/*"}
+    )
+    assert response.status_code == 200
+    assert response.content == b"some_webp"
+    assert response.headers["content-type"] == "image/webp"
+    assert response.headers["vary"] == "Accept"
+
+    response = client.get("/images/renditions/320.jpg", headers={"accept": "*/*"})
+    assert response.status_code == 200
+    assert response.content == b"some_jpeg"
+    assert response.headers["vary"] == "Accept"
@@ -0,0 +1,67 @@
+import pathlib
+
+import pytest
+
+from gallery.storage import LocalStorage, S3Storage, Storage
+
+
+def _put(storage: Storage, key: str, content: bytes):
+    staged = pathlib.Path(storage.staging_path(".upload-"))
+    staged.write_bytes(content)
+    storage.put(key, str(staged))
+    assert not staged.exists()
+
+
+def _check_storage(storage: Storage):
+    _put(storage, "ab/cd/abcd/original.jpg", b"some_image")
+    _put(storage, "ab/cd/abcd/renditions/320.jpg", b"some_rendition")
+
+    assert storage.exists("ab/cd/abcd/original.jpg")
+    assert not storage.exists("ab/cd/abcd/missing.jpg")
+
+    with storage.local_path("ab/cd/abcd/original.jpg") as local_path:
+        assert pathlib.Path(local_path).read_bytes() == b"some_image"
+
+    storage.delete_directory("ab/cd/abcd")
+
+    assert not storage.exists("ab/cd/abcd/original.jpg")
+    assert not storage.exists("ab/cd/abcd/renditions/320.jpg")
+
+
+def test_local_storage(tmp_path: pathlib.Path):
+    storage = LocalStorage(str(tmp_path))
+
+    _check_storage(storage)
+    assert storage.redirect_url("ab/cd/abcd/original.jpg") is None
+
+
+@pytest.mark.parametrize("key", ["", ".", "ab/..", "..", "/tmp"])
+def test_local_storage_refuses_to_delete_outside_directories(
+    tmp_path: pathlib.Path, key: str
+):
+    (tmp_path / "images").mkdir()
+    storage = LocalStorage(str(tmp_path / "images"))
+    _put(storage, "ab/cd/abcd/original.jpg", b"some_image")
+
+    with pytest.raises(ValueError):
+        storage.delete_directory(key)
+
+    assert storage.exists("ab/cd/abcd/original.jpg")
+
+
+def test_s3_storage(monkeypatch: pytest.MonkeyPatch):
+    moto = pytest.importorskip("moto")
+    boto3 = pytest.importorskip("boto3")
+
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+
+    with moto.mock_aws():
+        boto3.client("s3").create_bucket(Bucket="gallery")
+        storage = S3Storage("gallery", None, 60)
+
+        _check_storage(storage)
+        assert "ab/cd/abcd/original.jpg" in storage.redirect_url(
+            "ab/cd/abcd/original.jpg"
+        )
@@ -0,0 +1,52 @@
+import pathlib
+
+import pytest
+
+import gallery.config as config
+import gallery.templates as templates
+from gallery.templates import catalogs, negotiate_language
+
+
+@pytest.mark.parametrize(
+    "accept_language, expected",
+    [
+        ("", "en"),
+        ("de", "de"),
+        ("de-CH", "de"),
+        ("de-DE,de;q=0.9,en;q=0.8", "de"),
+        ("en-US,en;q=0.9,de;q=0.8", "en"),
+        ("fr,de;q=0.5,en;q=0.7", "en"),
+        ("de;q=0, en", "en"),
+        ("en;q=0.5, de;q=0.5", "en"),
+        ("fr, *;q=0.1", "en"),
+        ("de;q=oops, en;q=0.1", "en"),
+        ("fr", "en"),
+    ],
+)
+def test_negotiate_language(accept_language: str, expected: str):
+    assert negotiate_language(accept_language) == expected
+
+
+def test_catalogs_are_loaded_for_all_languages():
+    assert catalogs["de"].gettext("birthday") == "Geburtstag"
+    assert catalogs["en"].gettext("birthday") == "birthday"
+
+
+def test_init_caches_compiled_templates(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+):
+    env = templates.templates.env
+    monkeypatch.setattr(env, "bytecode_cache", None)
+    monkeypatch.setattr(env, "auto_reload", True)
+    # Templates loaded by other tests would not be compiled again
+    env.cache.clear()
+
+    gallery_config = config.get_config().model_copy()
+    gallery_config.template_cache_directory = str(tmp_path / "templates")
+    gallery_config.mode = config.ReleaseMode.PROD
+
+    templates.init(gallery_config)
+
+    names = env.list_templates(extensions=["jinja"])
+    assert len(list((tmp_path / "templates").iterdir())) == len(names)
+    assert env.auto_reload is False
@@ -0,0 +1,98 @@
+import multiprocessing
+import os
+import pathlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+from PIL import Image
+
+from gallery import worker
+from gallery.storage import LocalStorage
+
+
+def test_create_renditions(tmp_path: pathlib.Path):
+    img_path = tmp_path / "some_image.png"
+    Image.new("RGBA", (2100, 1400), color="blue").save(img_path)
+
+    renditions = worker.create_renditions(
+        LocalStorage(str(tmp_path)), "some_image.png", [640, 320, 1280, 2048]
+    )
+
+    assert [r["width"] for r in renditions] == [320, 640, 1280, 2048]
+    for rendition in renditions:
+        with Image.open(tmp_path / rendition["key"]) as img:
+            assert img.format == "JPEG"
+            assert img.size == (rendition["width"], round(rendition["width"] * 2 / 3))
+
+        for f in worker.RENDITION_FORMATS:
+            variant = (tmp_path / rendition["key"]).with_suffix(f.extension)
+            with Image.open(variant) as img:
+                assert img.format == f.name
+
+
+def test_create_renditions_of_small_image(tmp_path: pathlib.Path):
+    img_path = tmp_path / "some_image.jpg"
+    Image.new("RGB", (200, 100), color="blue").save(img_path)
+
+    renditions = worker.create_renditions(
+        LocalStorage(str(tmp_path)), "some_image.jpg", [320, 640]
+    )
+
+    assert [r["width"] for r in renditions] == [200]
+
+
+def test_rendition_directory_changes_with_settings():
+    first = worker.rendition_directory("ab/cd/abcd/original.jpg", [320, 640])
+
+    assert first.startswith("ab/cd/abcd/renditions-")
+    assert worker.rendition_directory("ab/cd/abcd/original.jpg", [640, 320]) == first
+    assert worker.rendition_directory("ab/cd/abcd/original.jpg", [320]) != first
+
+
+def test_negotiate_format():
+    assert worker.negotiate_format("image/webp,*/*").name == "WEBP"
+    assert worker.negotiate_format("*/*").name == "JPEG"
+    assert worker.negotiate_format("").name == "JPEG"
+    assert worker.negotiate_format("image/webp;q=0,*/*").name == "JPEG"
+    assert worker.negotiate_format("image/webp;q=0.5,image/jpeg").name == "JPEG"
+    assert worker.negotiate_format("image/webp,*/*;q=0.8").name == "WEBP"
+    assert worker.negotiate_format("image/webp;q=oops").name == "JPEG"
+
+
+def test_reserve_rejects_when_saturated(monkeypatch):
+    monkeypatch.setattr(worker, "slots", threading.BoundedSemaphore(1))
+
+    with worker.reserve():
+        with pytest.raises(worker.Saturated):
+            with worker.reserve():
+                pass
+
+    # Unused reservations are given back
+    with worker.reserve() as reservation:
+        assert reservation.submit(sum, [1, 2]).result() == 3
+
+    with worker.reserve():
+        pass
+
+
+def test_broken_pool_is_replaced(monkeypatch):
+    pool_options = {
+        "max_workers": 1,
+        "mp_context": multiprocessing.get_context("spawn"),
+    }
+    monkeypatch.setattr(worker, "pool_options", pool_options)
+    monkeypatch.setattr(worker, "executor", ProcessPoolExecutor(**pool_options))
+    monkeypatch.setattr(worker, "slots", threading.BoundedSemaphore(1))
+
+    try:
+        # Like a process killed for using too much memory
+        with worker.reserve(block=True) as reservation:
+            crashed = reservation.submit(os._exit, 1)
+        assert isinstance(crashed.exception(), BrokenProcessPool)
+
+        with worker.reserve(block=True) as reservation:
+            assert reservation.submit(sum, [1, 2]).result() == 3
+    finally:
+        worker.executor.shutdown()